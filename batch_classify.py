@@ -0,0 +1,126 @@
+import argparse
+import json
+import os
+import sys
+import threading
+from pipeline import Pipeline, MAX_PARALLEL_REQUESTS, URLS_PER_BATCH
+from rate_limit import RateLimiter
+from metrics import metrics
+
+
+def read_urls(f):
+    # Lines are either plain URLs or JSON objects with a "URL" or "url" field;
+    # broken JSON lines are reported and skipped
+    for number, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('{'):
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                metrics.count('batch_bad_lines_total')
+                print('Skipping line %d: %s' % (number, e), file=sys.stderr)
+                continue
+            url = record.get('URL') or record.get('url')
+            if url:
+                yield url
+        else:
+            yield line
+
+
+def done_urls(filename):
+    # URLs already written by an earlier, interrupted run
+    done = set()
+    if not os.path.isfile(filename):
+        return done
+    with open(filename, 'r') as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)['URL'])
+            except (ValueError, KeyError):
+                # The last line of a run that was killed may be cut off
+                pass
+    return done
+
+
+class JsonlWriter(object):
+    """Writes result rows as JSON lines as soon as they are classified"""
+
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, row):
+        with self.lock:
+            self.f.write(json.dumps(row) + '\n')
+            self.f.flush()
+            self.count += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Classify URLs from a file or stdin without the GUI, '
+                    'writing one JSON verdict per line')
+    parser.add_argument('input', nargs='?', default='-',
+                        help='file of URLs or JSON lines, - for stdin')
+    parser.add_argument('-o', '--output', default='-',
+                        help='JSONL file for the verdicts, - for stdout')
+    parser.add_argument('-w', '--workers', type=int,
+                        default=MAX_PARALLEL_REQUESTS,
+                        help='concurrent requests per stage')
+    parser.add_argument('-b', '--batch-size', type=int, default=URLS_PER_BATCH,
+                        help='URLs classified together')
+    parser.add_argument('--category-rate', type=float,
+                        help='maximum OpenAI requests per second, retries '
+                             'included; cached verdicts take none')
+    parser.add_argument('--trust-rate', type=float,
+                        help='maximum Safe Browsing lookup calls per second, '
+                             'retries included; cached verdicts take none')
+    parser.add_argument('--metrics',
+                        help='write stage latencies and counters to this JSON file')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the URLs already in the output file')
+    args = parser.parse_args()
+
+    done = set()
+    if args.resume and args.output != '-':
+        done = done_urls(args.output)
+
+    source = sys.stdin if args.input == '-' else open(args.input, 'r')
+    output = sys.stdout if args.output == '-' else open(args.output, 'a')
+    writer = JsonlWriter(output)
+    pipeline = Pipeline(
+        writer, args.workers, args.batch_size,
+        category_limiter=RateLimiter(args.category_rate) if args.category_rate else None,
+        trust_limiter=RateLimiter(args.trust_rate) if args.trust_rate else None)
+
+    # Skip finished URLs and repeats so a restarted run picks up where it stopped
+    def pending():
+        for url in read_urls(source):
+            if url not in done:
+                done.add(url)
+                yield url
+
+    try:
+        pipeline.run(pending())
+    except KeyboardInterrupt:
+        pipeline.cancel()
+        pipeline.wait()
+        print('Interrupted after %d URLs, rerun with --resume to continue'
+              % writer.count, file=sys.stderr)
+        return 130
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+        if args.metrics:
+            metrics.write_json(args.metrics)
+    print('Classified %d URLs' % writer.count, file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
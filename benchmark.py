@@ -0,0 +1,180 @@
+import argparse
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from fake_upstreams import FakeUpstreams
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(values, p):
+    # Nearest-rank percentile of a list of numbers
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(p / 100.0 * len(values)) - 1)]
+
+
+def summarize(name, latencies, urls, elapsed, **extra):
+    summary = {
+        'name': name,
+        'runs': len(latencies),
+        'urls': urls,
+        'elapsed_s': round(elapsed, 4),
+        'throughput_urls_per_s': round(urls / elapsed, 2) if elapsed else 0.0,
+        'mean_ms': round(1000 * sum(latencies) / len(latencies), 2) if latencies else 0.0,
+        'p50_ms': round(1000 * percentile(latencies, 50), 2),
+        'p95_ms': round(1000 * percentile(latencies, 95), 2),
+        'p99_ms': round(1000 * percentile(latencies, 99), 2),
+    }
+    summary.update(extra)
+    return summary
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def bench_pipeline(name, queries, stop, limiter):
+    # The search and classification Application.search runs for each query
+    from pipeline import Pipeline, search_results
+
+    latencies = []
+    first_results = []
+    urls = 0
+    started = time.perf_counter()
+    for query in queries:
+        rows = []
+        first = []
+        start = time.perf_counter()
+
+        def on_result(row):
+            if not first:
+                first.append(time.perf_counter() - start)
+            rows.append(row)
+
+        Pipeline(on_result).run(search_results(query, stop, limiter))
+        latencies.append(time.perf_counter() - start)
+        first_results.append(first[0] if first else latencies[-1])
+        urls += len(rows)
+    elapsed = time.perf_counter() - started
+    return summarize(name, latencies, urls, elapsed,
+                     first_result_p50_ms=round(1000 * percentile(first_results, 50), 2),
+                     first_result_p95_ms=round(1000 * percentile(first_results, 95), 2))
+
+
+def bench_calls(name, pages, function, batched):
+    # Time the upstream calls of every page, one URL per call or one page per call
+    latencies = []
+    urls = 0
+    started = time.perf_counter()
+    for page in pages:
+        if batched:
+            latency, _ = timed(function, page)
+            latencies.append(latency)
+        else:
+            for url in page:
+                latency, _ = timed(function, [url])
+                latencies.append(latency)
+        urls += len(page)
+    return summarize(name, latencies, urls, time.perf_counter() - started)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=HERE,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    upstreams = FakeUpstreams(args.openai_latency, args.safebrowsing_latency,
+                              args.search_latency, args.jitter)
+    upstreams.start()
+
+    # Caches, stores and credentials all live in a throwaway directory so
+    # that the cold runs really start cold
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='benchmark-')
+    os.chdir(workdir)
+    with open('credentials.json', 'w') as f:
+        json.dump({'openai': 'fake', 'google_safe': 'fake'}, f)
+    sys.path.insert(0, HERE)
+    upstreams.install()
+
+    from pipeline import search_results, SEARCH_RATE, SEARCH_BURST
+    from rate_limit import AdaptiveRateLimiter
+    from shopping_classifier import ask_categories
+    from trust_classifier import get_client
+
+    if args.search_rate is None:
+        args.search_rate = SEARCH_RATE
+    limiter = AdaptiveRateLimiter(args.search_rate, SEARCH_BURST)
+    queries = ['benchmark query %d' % i for i in range(args.queries)]
+    # The warm run finds the URLs and verdicts of the cold one in the caches
+    results = [
+        bench_pipeline('pipeline_cold', queries, args.stop, limiter),
+        bench_pipeline('pipeline_warm', queries, args.stop, limiter),
+    ]
+
+    pages = [list(search_results(query, args.stop)) for query in queries]
+    results.extend([
+        bench_calls('category_single', pages, ask_categories, False),
+        bench_calls('category_batched', pages, ask_categories, True),
+        bench_calls('trust_single', pages, get_client().lookup_urls, False),
+        bench_calls('trust_batched', pages, get_client().lookup_urls, True),
+    ])
+    from transport import get_transport
+    transport = get_transport().stats()
+    upstreams.stop()
+    os.chdir(cwd)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'commit': git_commit(),
+        'timestamp': time.time(),
+        'config': vars(args),
+        'upstream_calls': upstreams.calls,
+        'transport': transport,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the classification pipeline against local '
+                    'stand-ins for OpenAI, Safe Browsing and Google search')
+    parser.add_argument('--queries', type=int, default=5)
+    parser.add_argument('--stop', type=int, default=10,
+                        help='search results per query')
+    parser.add_argument('--search-rate', type=float, default=None,
+                        help='Google requests per second, defaults to '
+                             'the rate the application starts at')
+    parser.add_argument('--openai-latency', type=float, default=0.5)
+    parser.add_argument('--safebrowsing-latency', type=float, default=0.1)
+    parser.add_argument('--search-latency', type=float, default=0.3)
+    parser.add_argument('--jitter', type=float, default=0.2,
+                        help='latencies vary by up to this fraction')
+    parser.add_argument('-o', '--output',
+                        help='append the report to this JSONL file')
+    args = parser.parse_args()
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    report = run(args)
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(report) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import json
+import os
+import threading
+
+CREDENTIALS_FILENAME = 'credentials.json'
+# Names another credentials file to use, e.g. for batch workers
+CREDENTIALS_ENV = 'CLASSIFIER_CREDENTIALS'
+
+
+def find_key_value(data, key):
+    if isinstance(data, dict):
+        for k, v in data.items():
+            if k == key:
+                return v
+            elif isinstance(v, (dict, list)):
+                result = find_key_value(v, key)
+                if result is not None:
+                    return result
+    elif isinstance(data, list):
+        for item in data:
+            result = find_key_value(item, key)
+            if result is not None:
+                return result
+
+    return None
+
+
+class Credentials(object):
+    """API keys read from the credentials file the first time one is needed"""
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.data = None
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def path(self):
+        return self.filename or os.environ.get(CREDENTIALS_ENV, CREDENTIALS_FILENAME)
+
+    def get(self, key):
+        # The file is only parsed once; a missing file is looked for again
+        # on the next call, so it can be created while the program runs
+        with self.lock:
+            if key not in self.values:
+                if self.data is None:
+                    with open(self.path(), 'r') as json_file:
+                        self.data = json.load(json_file)
+                self.values[key] = find_key_value(self.data, key)
+            return self.values[key]
+
+    def reload(self):
+        with self.lock:
+            self.data = None
+            self.values = {}
+
+
+_credentials = Credentials()
+
+
+def get_credentials(key):
+    return _credentials.get(key)
+
+
+def reload_credentials():
+    # Forget the credentials read so far, e.g. after the file changed
+    _credentials.reload()
@@ -0,0 +1,258 @@
+import base64
+import hashlib
+import json
+import random
+import re
+import socket
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, quote
+
+# Number of distinct sites the fake search engine links to
+SITES = 1000
+NUMBERED_URL = re.compile(r'^(\d+)\. (\S+)$', re.M)
+URL = re.compile(r'https?://\S+')
+
+
+def _percent(text):
+    return zlib.crc32(text.encode('utf-8')) % 100
+
+
+class FakeUpstreams(object):
+    """Local stand-ins for OpenAI, Safe Browsing and Google search with
+    configurable latency, serving deterministic answers on one HTTP port"""
+
+    def __init__(self, openai_latency=0.5, safebrowsing_latency=0.1,
+                 search_latency=0.3, jitter=0.2, shopping_percent=30,
+                 malicious_percent=5):
+        self.latency = {'openai': openai_latency,
+                        'safebrowsing': safebrowsing_latency,
+                        'search': search_latency}
+        self.jitter = jitter
+        self.shopping_percent = shopping_percent
+        self.malicious_percent = malicious_percent
+        # Sites put on or taken off the threat lists by set_malicious, and
+        # the sorted malware prefixes of each version of the lists served
+        self.overrides = {}
+        self.versions = []
+        # Seconds full hashes stay unsafe or safe in the clients' caches,
+        # updates answered with a wrong checksum, and seconds an update
+        # response is held back on top of the latency
+        self.positive_cache_seconds = 300
+        self.negative_cache_seconds = 300
+        self.corrupt_updates = 0
+        self.update_delay = 0.0
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def is_shopping(self, url):
+        return _percent('shop:' + (urlsplit(url).hostname or '')) < self.shopping_percent
+
+    def is_malicious(self, host):
+        if host in self.overrides:
+            return self.overrides[host]
+        return _percent('evil:' + host) < self.malicious_percent
+
+    def malicious_hashes(self):
+        # Full hashes of the host expressions of every malicious site
+        hosts = set('site%d.example' % k for k in range(SITES))
+        hosts.update(self.overrides)
+        return sorted(hashlib.sha256((host + '/').encode()).digest()
+                      for host in hosts if self.is_malicious(host))
+
+    def malware_prefixes(self):
+        return sorted(h[:4] for h in self.malicious_hashes())
+
+    def set_malicious(self, host, malicious=True):
+        # Put a site on the malware list or take it off, which publishes a
+        # new version of the lists for partial updates to fetch
+        with self.lock:
+            if not self.versions:
+                self.versions.append(self.malware_prefixes())
+            self.overrides[host] = malicious
+            self.versions.append(self.malware_prefixes())
+
+    def start(self):
+        upstreams = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                # Headers and body go out in separate writes, which stall
+                # for a delayed ACK on kept-alive connections without this
+                super().setup()
+                self.connection.setsockopt(socket.IPPROTO_TCP,
+                                           socket.TCP_NODELAY, 1)
+
+            def do_GET(self):
+                upstreams.handle(self, None)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                upstreams.handle(self, json.loads(self.rfile.read(length) or b'{}'))
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.base_url
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%d' % self.server.server_port
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def wait(self, upstream):
+        latency = self.latency[upstream]
+        time.sleep(max(0.0, latency * random.uniform(1 - self.jitter, 1 + self.jitter)))
+
+    def handle(self, request, body):
+        path = urlsplit(request.path).path
+        if path.startswith('/v1/'):
+            upstream, response = 'openai', self.completion(body)
+        elif path.startswith('/v4/'):
+            upstream, response = 'safebrowsing', self.safebrowsing(path, body)
+        else:
+            upstream, response = 'search', self.search(request.path)
+        with self.lock:
+            self.calls[path] = self.calls.get(path, 0) + 1
+        self.wait(upstream)
+
+        if isinstance(response, str):
+            data, content_type = response.encode('utf-8'), 'text/html'
+        else:
+            data, content_type = json.dumps(response).encode('utf-8'), 'application/json'
+        request.send_response(200)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def completion(self, body):
+        prompt = body.get('prompt', '')
+        numbered = NUMBERED_URL.findall(prompt)
+        if numbered:
+            text = '\n'.join('%s: %s' % (i, 'shopping' if self.is_shopping(url)
+                                         else 'information')
+                             for i, url in numbered)
+        else:
+            url = URL.findall(prompt)[-1].rstrip('.')
+            text = 'Shopping' if self.is_shopping(url) else 'Information'
+        return {'id': 'fake', 'object': 'text_completion', 'created': 0,
+                'model': 'fake', 'choices': [{'text': text, 'index': 0,
+                                              'logprobs': None,
+                                              'finish_reason': 'stop'}]}
+
+    def safebrowsing(self, path, body):
+        if path.endswith('threatMatches:find'):
+            matches = []
+            for entry in body['threatInfo']['threatEntries']:
+                if self.is_malicious(urlsplit(entry['url']).hostname or ''):
+                    matches.append({'threatType': 'MALWARE',
+                                    'platformType': 'ANY_PLATFORM',
+                                    'threatEntryType': 'URL',
+                                    'threat': {'url': entry['url']},
+                                    'cacheDuration': '300s'})
+            return {'matches': matches} if matches else {}
+
+        if path.endswith('threatListUpdates:fetch'):
+            return self.list_updates(body)
+
+        # fullHashes:find
+        wanted = set(base64.b64decode(e['hash'])
+                     for e in body['threatInfo']['threatEntries'])
+        return {'matches': [{'threatType': 'MALWARE',
+                             'platformType': 'ANY_PLATFORM',
+                             'threatEntryType': 'URL',
+                             'threat': {'hash': base64.b64encode(h).decode('ascii')},
+                             'cacheDuration': '%gs' % self.positive_cache_seconds}
+                            for h in self.malicious_hashes() if h[:4] in wanted],
+                'negativeCacheDuration': '%gs' % self.negative_cache_seconds}
+
+    def list_updates(self, body):
+        # Malware lists every malicious site, the other lists are empty. A
+        # client whose state names a known version gets the changes since
+        # then, as removal indices into its sorted prefixes and additions;
+        # any other client gets the whole list.
+        time.sleep(self.update_delay)
+        with self.lock:
+            if not self.versions:
+                self.versions.append(self.malware_prefixes())
+            version = len(self.versions) - 1
+            current = self.versions[-1]
+            corrupt = self.corrupt_updates > 0
+            if corrupt:
+                self.corrupt_updates -= 1
+        responses = []
+        for request in body['listUpdateRequests']:
+            response = {'threatType': request['threatType'],
+                        'platformType': request['platformType'],
+                        'threatEntryType': request['threatEntryType'],
+                        'responseType': 'FULL_UPDATE',
+                        'newClientState': str(version)}
+            prefixes = current if request['threatType'] == 'MALWARE' else []
+            state = request.get('state', '')
+            additions = prefixes
+            if state.isdigit() and int(state) <= version:
+                old = self.versions[int(state)] if prefixes else []
+                response['responseType'] = 'PARTIAL_UPDATE'
+                kept = set(prefixes)
+                removals = [i for i, p in enumerate(old) if p not in kept]
+                if removals:
+                    response['removals'] = [{'compressionType': 'RAW',
+                                             'rawIndices': {'indices': removals}}]
+                known = set(old)
+                additions = [p for p in prefixes if p not in known]
+            if additions:
+                response['additions'] = [{
+                    'compressionType': 'RAW',
+                    'rawHashes': {'prefixSize': 4, 'rawHashes':
+                                  base64.b64encode(b''.join(additions)).decode('ascii')}}]
+            expected = b''.join(prefixes) + (b'corrupt' if corrupt else b'')
+            response['checksum'] = {'sha256': base64.b64encode(
+                hashlib.sha256(expected).digest()).decode('ascii')}
+            responses.append(response)
+        return {'listUpdateResponses': responses,
+                'minimumWaitDuration': '1800s'}
+
+    def search(self, path):
+        # Ten results per page, spread over the fake sites
+        query = parse_qs(urlsplit(path).query)
+        if 'q' not in query:
+            return '<html><body>Home</body></html>'
+        text = query['q'][0]
+        start = int(query.get('start', ['0'])[0])
+        links = []
+        for i in range(start, start + 10):
+            site = zlib.crc32(('%s:%d' % (text, i)).encode('utf-8')) % SITES
+            url = 'https://site%d.example/%s/%d' % (site, quote(text), i)
+            links.append('<a href="/url?q=%s">%s</a>' % (quote(url, safe=''), url))
+        return '<html><body><div id="search">%s</div></body></html>' % ''.join(links)
+
+    def install(self):
+        # Point every client of the classifiers at the stand-ins
+        import googlesearch
+        import openai
+        import trust_classifier
+        from safebrowsing_db import SafeBrowsingDatabase
+        from transport import get_transport
+
+        base = self.base_url
+        openai.api_base = base + '/v1'
+        trust_classifier._client = trust_classifier.SafeBrowsingClient(
+            'fake', api_url=base + '/v4/threatMatches:find')
+        trust_classifier._database = SafeBrowsingDatabase(
+            'fake', api_base=base + '/v4', session=get_transport().session)
+        for name in ('url_home', 'url_search', 'url_next_page',
+                     'url_search_num', 'url_next_page_num'):
+            setattr(googlesearch, name, getattr(googlesearch, name).replace(
+                'https://www.google.%(tld)s', base))
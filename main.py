@@ -1,12 +1,88 @@
-import json
 import os
+import threading
 from PyQt5 import QtWidgets, QtGui, QtCore
 from PyQt5.QtGui import QIcon
-from PyQt5.QtWidgets import QApplication
-from shopping_classifier import check_category
-from trust_classifier import check_url
+from pipeline import (Pipeline, Prefetcher, search_results, preload,
+                      MAX_PARALLEL_REQUESTS, URLS_PER_BATCH,
+                      RESULTS_PER_SEARCH, PREFETCH_QUERIES)
+from resilience import SEARCH_BUDGET
+from results_store import get_store
+from results_model import ResultsModel, ResultsFilter
+from metrics import metrics, next_profiler, METRICS_ENV
 import random
-from googlesearch import search
+
+# Milliseconds result rows are collected for before the table shows them
+FLUSH_INTERVAL = 50
+
+
+class SearchSignals(QtCore.QObject):
+    # Signals carry the id of the search so stale ones can be ignored
+    result = QtCore.pyqtSignal(int, dict)
+    finished = QtCore.pyqtSignal(int, str, list, bool)
+    error = QtCore.pyqtSignal(int, str)
+
+
+class SearchWorker(QtCore.QRunnable):
+    """Streams search results through the classification pipeline off the GUI thread"""
+
+    def __init__(self, search_id, query, stop=RESULTS_PER_SEARCH,
+                 max_parallel=MAX_PARALLEL_REQUESTS,
+                 urls_per_batch=URLS_PER_BATCH):
+        super().__init__()
+        self.search_id = search_id
+        self.query = query
+        self.stop = stop
+        self.signals = SearchSignals()
+        self.cancelled = threading.Event()
+        self.pipeline = Pipeline(self.emit, max_parallel, urls_per_batch,
+                                 budget=SEARCH_BUDGET)
+        self.rows = {}
+        self.rows_lock = threading.Lock()
+
+    def cancel(self):
+        self.cancelled.set()
+        self.pipeline.cancel()
+
+    def run(self):
+        # Profile every thread of this search when profiling was asked for
+        profiler = next_profiler()
+        self.pipeline.profiler = profiler
+        try:
+            if profiler is None:
+                self.classify()
+            else:
+                with profiler.thread():
+                    self.classify()
+                profiler.save()
+        except Exception as e:
+            self.pipeline.cancel()
+            if not self.cancelled.is_set():
+                self.signals.error.emit(self.search_id, str(e))
+
+    def classify(self):
+        URLs = []
+        info = {}
+
+        def results():
+            for url in search_results(self.query, self.stop, info=info):
+                URLs.append(url)
+                yield url
+
+        self.pipeline.run(results())
+        if self.cancelled.is_set():
+            return
+
+        # Save the results in the order of the search
+        rows = [self.rows[url] for url in URLs if url in self.rows]
+        self.signals.finished.emit(self.search_id, self.query, rows,
+                                   info.get('cached', False))
+
+    def emit(self, row):
+        if self.cancelled.is_set():
+            return
+        with self.rows_lock:
+            self.rows[row['URL']] = row
+        self.signals.result.emit(self.search_id, row)
 
 
 class Application(QtWidgets.QWidget):
@@ -45,11 +121,11 @@ class Application(QtWidgets.QWidget):
                 border-radius: 4px;
                 background-color: white;
             }
-            QTableWidget {
+            QTableView {
                 gridline-color: #D3D3D3;
                 selection-background-color: #007BFF;
             }
-            QTableWidget::item:hover {
+            QTableView::item:hover {
                 background-color: #E0E0E0;
             }
         """)
@@ -68,116 +144,144 @@ class Application(QtWidgets.QWidget):
 
         search_layout.addWidget(self.query_label)
         search_layout.addWidget(self.query_entry)
+
+        # Number of search results to classify
+        self.results_count = QtWidgets.QSpinBox()
+        self.results_count.setRange(10, 100)
+        self.results_count.setSingleStep(10)
+        self.results_count.setValue(RESULTS_PER_SEARCH)
+        self.results_count.setSuffix(' results')
+        self.results_count.setFixedHeight(30)
+        search_layout.addWidget(self.results_count)
         search_layout.addWidget(self.search_button)
 
         layout.addLayout(search_layout)
 
+        results_layout = QtWidgets.QHBoxLayout()
         self.results_label = QtWidgets.QLabel('Results:')
-        layout.addWidget(self.results_label)
-
-        self.scroll_area = QtWidgets.QScrollArea()
-        self.scroll_area.setWidgetResizable(True)
-
-        self.result_table = QtWidgets.QTableWidget(0, 3)
-        self.result_table.setHorizontalHeaderLabels(
-            ['Searched URL', 'Category', 'Trusted'])
-        self.scroll_area.setWidget(self.result_table)
-        self.result_table.horizontalHeader().setSectionResizeMode(
-            0, QtWidgets.QHeaderView.Stretch)
-        self.result_table.horizontalHeader().setSectionResizeMode(
-            1, QtWidgets.QHeaderView.ResizeToContents)
-        self.result_table.horizontalHeader().setSectionResizeMode(
-            2, QtWidgets.QHeaderView.ResizeToContents)
+        self.filter_entry = QtWidgets.QLineEdit()
+        self.filter_entry.setFixedHeight(30)
+        self.filter_entry.setPlaceholderText("Filter Results")
+        results_layout.addWidget(self.results_label)
+        results_layout.addWidget(self.filter_entry)
+        layout.addLayout(results_layout)
+
+        # The table only asks the model for the rows it paints, so it stays
+        # fast with thousands of results
+        self.result_model = ResultsModel(self)
+        self.result_filter = ResultsFilter(self)
+        self.result_filter.setSourceModel(self.result_model)
+        self.filter_entry.textChanged.connect(
+            self.result_filter.setFilterFixedString)
+
+        self.result_table = QtWidgets.QTableView()
+        self.result_table.setModel(self.result_filter)
+        self.result_table.setSortingEnabled(True)
+        self.result_table.sortByColumn(-1, QtCore.Qt.AscendingOrder)
+        header = self.result_table.horizontalHeader()
+        header.setSectionResizeMode(0, QtWidgets.QHeaderView.Stretch)
+        header.setSectionResizeMode(1, QtWidgets.QHeaderView.ResizeToContents)
+        header.setSectionResizeMode(2, QtWidgets.QHeaderView.ResizeToContents)
+        # Size the columns from the rows on screen rather than all of them
+        header.setResizeContentsPrecision(0)
+        rows = self.result_table.verticalHeader()
+        rows.setSectionResizeMode(QtWidgets.QHeaderView.Fixed)
+        rows.hide()
 
         self.result_table.setSelectionBehavior(
             QtWidgets.QAbstractItemView.SelectRows)
         self.result_table.setMouseTracking(True)
 
-        layout.addWidget(self.scroll_area)
+        layout.addWidget(self.result_table)
+
+        self.result_table.doubleClicked.connect(self.open_url)
+
+        # Rows arriving together are added to the model in one batch
+        self.pending_results = []
+        self.flush_timer = QtCore.QTimer(self)
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.setInterval(FLUSH_INTERVAL)
+        self.flush_timer.timeout.connect(self.flush_results)
+
+        # Searches run on a worker thread so the window stays responsive
+        self.thread_pool = QtCore.QThreadPool.globalInstance()
+        self.search_id = 0
+        self.worker = None
+
+        # Searches are appended to the results store
+        self.store = get_store()
+
+        # Popular queries are searched again in the background when enabled,
+        # so that repeating them skips Google
+        self.prefetcher = None
+        if PREFETCH_QUERIES:
+            self.prefetcher = Prefetcher(PREFETCH_QUERIES)
+            self.prefetcher.start()
 
     def search(self):
         query = self.query_entry.text()
         if query:
-            URLs = [j for j in search(query, num=10, stop=10, pause=2)]
-
-            self.result_table.setRowCount(0)
-
-            json_filename = 'search_results.json'
-            if os.path.isfile(json_filename):
-                with open(json_filename, 'r') as f:
-                    data = json.load(f)
-            else:
-                data = []
-
-            search_results = []
-            for url in URLs:
-                row_position = self.result_table.rowCount()
-                self.result_table.insertRow(row_position)
-
-                is_shopping = check_category(url)
-
-                if is_shopping:
-                    category = "Shopping"
-                else:
-                    category = "Information"
-
-                if is_shopping:
-                    status = check_url(url)
-                    if status == 'Trusted':
-                        trusted = "Yes"
-                    else:
-                        trusted = "No"
-                else:
-                    trusted = ""
-
-                search_results.append(
-                    {'URL': url, 'Category': category, 'Trusted': trusted})
-
-                searched_url_item = QtWidgets.QTableWidgetItem(url)
-                category_item = QtWidgets.QTableWidgetItem(category)
-                trusted_item = QtWidgets.QTableWidgetItem(trusted)
-
-                if not is_shopping:
-                    searched_url_item.setBackground(
-                        QtGui.QColor(255, 255, 230))
-                    category_item.setBackground(QtGui.QColor(255, 255, 230))
-                    trusted_item.setBackground(QtGui.QColor(255, 255, 230))
-
-                elif trusted == "Yes":
-                    searched_url_item.setBackground(
-                        QtGui.QColor(230, 255, 230))
-                    category_item.setBackground(QtGui.QColor(230, 255, 230))
-                    trusted_item.setBackground(QtGui.QColor(230, 255, 230))
-                else:
-                    searched_url_item.setBackground(
-                        QtGui.QColor(255, 230, 230))
-                    category_item.setBackground(QtGui.QColor(255, 230, 230))
-                    trusted_item.setBackground(QtGui.QColor(255, 230, 230))
-
-                if trusted == "Yes":
-                    # searched_url_item.setFlags(searched_url_item.flags() | QtCore.Qt.ItemIsEditable)
-                    searched_url_item.setData(
-                        QtCore.Qt.UserRole, QtCore.QUrl(url))
-
-                self.result_table.setItem(row_position, 0, searched_url_item)
-                self.result_table.setItem(row_position, 1, category_item)
-                self.result_table.setItem(row_position, 2, trusted_item)
-
-                QApplication.processEvents()
-
-            self.result_table.cellDoubleClicked.connect(self.open_url)
-
-            data.append({'query': query, 'results': search_results})
-
-            with open(json_filename, 'w') as f:
-                json.dump(data, f, indent=4)
-
-    def open_url(self, row, column):
-        if column == 0:
-            item = self.result_table.item(row, column)
-            url = item.data(QtCore.Qt.UserRole)
-            if url is not None:
-                QtGui.QDesktopServices.openUrl(url)
+            # A new query cancels the search that is still running
+            if self.worker is not None:
+                self.worker.cancel()
+
+            self.flush_timer.stop()
+            self.pending_results = []
+            self.result_model.clear()
+
+            self.search_id += 1
+            self.worker = SearchWorker(self.search_id, query,
+                                       stop=self.results_count.value())
+            self.worker.signals.result.connect(self.add_result)
+            self.worker.signals.finished.connect(self.save_results)
+            self.worker.signals.error.connect(self.show_error)
+            self.thread_pool.start(self.worker)
+
+    def add_result(self, search_id, result):
+        # Ignore the rows of a cancelled search
+        if search_id != self.search_id:
+            return
+
+        self.pending_results.append(result)
+        if not self.flush_timer.isActive():
+            self.flush_timer.start()
+
+    def flush_results(self):
+        results, self.pending_results = self.pending_results, []
+        with metrics.span('ui_update'):
+            self.result_model.add_results(results)
+
+    def save_results(self, search_id, query, search_results, cached):
+        if search_id != self.search_id:
+            return
+        self.worker = None
+        self.flush_timer.stop()
+        self.flush_results()
+
+        with metrics.span('persistence'):
+            # Searches answered from the query cache are marked, so that
+            # warming the cache does not take their URLs for new ones
+            self.store.append(query, search_results, cached=cached)
+
+    def show_error(self, search_id, message):
+        if search_id != self.search_id:
+            return
+        self.worker = None
+        QtWidgets.QMessageBox.warning(self, 'Search failed', message)
+
+    def closeEvent(self, event):
+        if self.prefetcher is not None:
+            self.prefetcher.cancel()
+        # Keep the metrics of the session when CLASSIFIER_METRICS names a file
+        filename = os.environ.get(METRICS_ENV)
+        if filename:
+            metrics.write_json(filename)
+        super().closeEvent(event)
+
+    def open_url(self, index):
+        url = index.data(QtCore.Qt.UserRole)
+        if url is not None:
+            QtGui.QDesktopServices.openUrl(url)
 
 
 if __name__ == '__main__':
@@ -188,5 +292,7 @@ if __name__ == '__main__':
     app.setWindowIcon(app_icon)
     # Show the window
     window.show()
+    # Import the upstream libraries while the user types the first query
+    threading.Thread(target=preload, daemon=True).start()
     # Start the application event loop
     app.exec_()
@@ -0,0 +1,213 @@
+import bisect
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, 30.0, 60.0)
+# File the cProfile stats of the next search are written to, when set
+PROFILE_ENV = 'CLASSIFIER_PROFILE'
+# File the GUI writes its metrics to when it closes, when set
+METRICS_ENV = 'CLASSIFIER_METRICS'
+
+
+class Histogram(object):
+    """Latency histogram with fixed buckets"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                             for k, v in pairs)
+
+
+class Metrics(object):
+    """In-process stage latencies and event counters"""
+
+    def __init__(self, prefix='classifier'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name, n=1, **labels):
+        key = (name, _labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def value(self, name, **labels):
+        with self.lock:
+            return self.counters.get((name, _labels(labels)), 0)
+
+    @contextmanager
+    def span(self, stage):
+        # Time a stage and count its calls and errors
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.count('errors_total', stage=stage)
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+            self.count('calls_total', stage=stage)
+
+    def timed_iter(self, stage, iterable):
+        # Time only the waits for the items of an iterable, like result pages
+        waited = 0.0
+        iterator = iter(iterable)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    waited += time.perf_counter() - start
+                yield item
+        except Exception:
+            self.count('errors_total', stage=stage)
+            raise
+        finally:
+            self.observe(stage, waited)
+            self.count('calls_total', stage=stage)
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def prometheus(self):
+        # Prometheus text exposition format
+        lines = []
+        with self.lock:
+            name = '%s_stage_seconds' % self.prefix
+            if self.histograms:
+                lines.append('# TYPE %s histogram' % name)
+            for stage, histogram in sorted(self.histograms.items()):
+                labels = (('stage', stage),)
+                for bound, total in histogram.cumulative():
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('%s_bucket%s %d' % (
+                        name, _format_labels(labels, [('le', le)]), total))
+                lines.append('%s_sum%s %r' % (name, _format_labels(labels),
+                                               histogram.sum))
+                lines.append('%s_count%s %d' % (name, _format_labels(labels),
+                                                 histogram.count))
+            typed = set()
+            for (counter, labels), value in sorted(self.counters.items()):
+                name = '%s_%s' % (self.prefix, counter)
+                if name not in typed:
+                    typed.add(name)
+                    lines.append('# TYPE %s counter' % name)
+                lines.append('%s%s %d' % (name, _format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self):
+        with self.lock:
+            return {
+                'stages': dict((stage, {
+                    'count': h.count,
+                    'sum_s': h.sum,
+                    'buckets': dict(('+Inf' if b == float('inf') else repr(b), t)
+                                    for b, t in h.cumulative()),
+                }) for stage, h in self.histograms.items()),
+                'counters': [dict(labels, name=name, value=value)
+                             for (name, labels), value in
+                             sorted(self.counters.items())],
+            }
+
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.dump(), f, indent=4)
+
+
+metrics = Metrics()
+
+
+_profiling = threading.local()
+
+
+def current_profiler():
+    # The Profiler of the work running on the current thread, if any
+    return getattr(_profiling, 'profiler', None)
+
+
+class Profiler(object):
+    """Collects cProfile stats from every thread taking part in one search"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def thread(self):
+        # cProfile only sees the thread it was enabled in; work the thread
+        # hands to a pool finds the profiler through current_profiler()
+        previous = current_profiler()
+        _profiling.profiler = self
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            _profiling.profiler = previous
+            with self.lock:
+                self.profiles.append(profile)
+
+    def call(self, function, *args):
+        # Run function profiled, e.g. on a thread of a pool
+        with self.thread():
+            return function(*args)
+
+    def save(self):
+        with self.lock:
+            if not self.profiles:
+                return
+            stats = pstats.Stats(*self.profiles)
+        stats.dump_stats(self.filename)
+
+
+def next_profiler():
+    # A profiler for the next search when CLASSIFIER_PROFILE names a file;
+    # the variable is cleared so only one search is profiled
+    filename = os.environ.pop(PROFILE_ENV, None)
+    return Profiler(filename) if filename else None
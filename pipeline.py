@@ -0,0 +1,356 @@
+import queue
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from urllib.error import HTTPError
+from metrics import metrics
+from query_cache import get_query_cache
+from rate_limit import AdaptiveRateLimiter
+from resilience import Deadline, deadline, rate_limited
+from transport import get_transport
+from shopping_classifier import check_categories
+from trust_classifier import check_urls
+
+# Default number of search results classified per query
+RESULTS_PER_SEARCH = 10
+# Requests sent to Google per second, in bursts of SEARCH_BURST; a search
+# sends one for the home page and one per result page. The rate starts at
+# SEARCH_RATE, creeps up towards MAX_SEARCH_RATE while Google answers and
+# halves whenever it throttles.
+SEARCH_RATE = 0.5
+SEARCH_BURST = 2
+MIN_SEARCH_RATE = 1 / 60.0
+MAX_SEARCH_RATE = 4.0
+# Times a throttled request is sent again before the search fails
+SEARCH_RETRIES = 3
+# HTTP statuses Google throttles with
+THROTTLED_STATUSES = (429, 503)
+# Number of popular queries kept fresh in the query cache in the background,
+# 0 for none, and the seconds between checks for ones about to expire
+PREFETCH_QUERIES = 0
+PREFETCH_INTERVAL = 15 * 60
+# Maximum number of batches of URLs classified at the same time by each stage
+MAX_PARALLEL_REQUESTS = 4
+# Number of URLs classified together; 1 classifies every URL on its own
+URLS_PER_BATCH = 3
+# URLs waiting for a stage before the previous stage has to wait for it
+QUEUE_SIZE = 20
+
+# Marks the end of the items of a stage
+STOP = object()
+
+
+_search = None
+_search_lock = threading.Lock()
+_search_limiter = None
+_search_limiter_lock = threading.Lock()
+_pacing = threading.local()
+
+
+def get_search_limiter():
+    # Every search of the process shares one budget of Google requests
+    global _search_limiter
+    with _search_limiter_lock:
+        if _search_limiter is None:
+            _search_limiter = AdaptiveRateLimiter(
+                SEARCH_RATE, SEARCH_BURST, min_rate=MIN_SEARCH_RATE,
+                max_rate=MAX_SEARCH_RATE)
+    return _search_limiter
+
+
+def retry_after(error):
+    # Seconds a throttled response asks us to wait, when it says
+    try:
+        return float(error.headers.get('Retry-After'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+@contextmanager
+def pacing(limiter):
+    # Pace the Google requests the current thread sends with the limiter
+    previous = getattr(_pacing, 'limiter', None)
+    _pacing.limiter = limiter
+    try:
+        yield limiter
+    finally:
+        _pacing.limiter = previous
+
+
+def get_page(url, user_agent=None, verify_ssl=True):
+    # googlesearch.get_page over the shared transport, taking a token for
+    # every request and backing off when Google throttles
+    limiter = getattr(_pacing, 'limiter', None) or get_search_limiter()
+    for attempt in range(SEARCH_RETRIES + 1):
+        limiter.acquire()
+        try:
+            page = get_transport().get_page(url, user_agent, verify_ssl)
+        except HTTPError as e:
+            if e.code not in THROTTLED_STATUSES or attempt == SEARCH_RETRIES:
+                raise
+            metrics.count('search_throttled_total')
+            limiter.throttled(retry_after(e))
+        else:
+            limiter.succeeded()
+            return page
+
+
+def get_search():
+    # googlesearch.search, fetching its pages through get_page
+    global _search
+    with _search_lock:
+        if _search is None:
+            import googlesearch
+            googlesearch.get_page = get_page
+            _search = googlesearch.search
+    return _search
+
+
+def fetch_results(query, stop, limiter=None, cache=None):
+    # Yield the URLs of a Google search page by page, and keep them in the
+    # query cache once the search has finished. One search fetches the home
+    # page once and then the result pages until stop URLs are found or a
+    # page has no new ones.
+    results = get_search()(query, num=10, stop=stop, pause=0)
+    urls = []
+    while True:
+        # The limiter only paces this search while it runs, not the caller
+        # between two URLs
+        with pacing(limiter):
+            url = next(results, None)
+        if url is None:
+            break
+        urls.append(url)
+        yield url
+    if cache is not None:
+        cache.set(query, urls, len(urls) < stop)
+
+
+def preload():
+    # Import the upstream libraries ahead of the first search, e.g. on a
+    # background thread while the window opens
+    import googlesearch
+    import openai
+    import requests
+
+
+def search_results(query, stop=RESULTS_PER_SEARCH, limiter=None, use_cache=True,
+                   info=None):
+    # Yield the URLs of a Google search as the result pages arrive, or all at
+    # once when the query was searched recently; info, when given, gets
+    # 'cached' telling which
+    cache = get_query_cache() if use_cache else None
+    if info is not None:
+        info['cached'] = False
+    if cache is not None:
+        urls = cache.get(query, stop)
+        if urls is not None:
+            if info is not None:
+                info['cached'] = True
+            return iter(urls)
+    return metrics.timed_iter('search', fetch_results(query, stop, limiter, cache))
+
+
+def prefetch_popular(queries=PREFETCH_QUERIES, stop=RESULTS_PER_SEARCH,
+                     interval=PREFETCH_INTERVAL, limiter=None):
+    # Search the most popular queries again when their URLs would expire
+    # before the next check
+    cache = get_query_cache()
+    expiring = time.time() - cache.ttl + interval
+    for query, created in cache.popular(queries):
+        if created >= expiring:
+            continue
+        try:
+            with metrics.span('prefetch'):
+                for _ in fetch_results(query, stop, limiter, cache):
+                    pass
+        except Exception:
+            # A failed prefetch only means the next search goes to Google
+            pass
+
+
+class Prefetcher(object):
+    """Background thread keeping the query cache fresh for popular queries"""
+
+    def __init__(self, queries=PREFETCH_QUERIES, interval=PREFETCH_INTERVAL):
+        self.queries = queries
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.work, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def cancel(self):
+        self.stopped.set()
+
+    def work(self):
+        while not self.stopped.is_set():
+            prefetch_popular(self.queries, interval=self.interval)
+            self.stopped.wait(self.interval)
+
+
+def category_row(url, is_shopping, source=None):
+    # Build the result row of a URL; shopping URLs get a trust status later.
+    # Rows categorized by the local model say so, so that it is never
+    # trained on its own answers.
+    if is_shopping is None:
+        row = {'URL': url, 'Category': "Unknown", 'Trusted': ""}
+    elif is_shopping:
+        row = {'URL': url, 'Category': "Shopping", 'Trusted': ""}
+    else:
+        row = {'URL': url, 'Category': "Information", 'Trusted': ""}
+    if source:
+        row['Source'] = source
+    return row
+
+
+def trust_row(row, status):
+    if status == 'Trusted':
+        return dict(row, Trusted="Yes")
+    if status == 'Unknown':
+        return dict(row, Trusted="Unknown")
+    return dict(row, Trusted="No")
+
+
+class Stage(object):
+    """Pool of threads handling batches of items from a bounded queue"""
+
+    def __init__(self, handle, stopped, workers=MAX_PARALLEL_REQUESTS,
+                 batch_size=URLS_PER_BATCH, queue_size=QUEUE_SIZE):
+        self.handle = handle
+        self.stopped = stopped
+        self.batch_size = batch_size
+        self.error = None
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.threads = [threading.Thread(target=self.work, daemon=True)
+                        for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, item):
+        # Block while the queue is full so a fast stage waits for a slow one
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def close(self):
+        for _ in self.threads:
+            self.put(STOP)
+        for thread in self.threads:
+            thread.join()
+
+    def work(self):
+        done = False
+        while not done and not self.stopped.is_set():
+            try:
+                item = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is STOP:
+                break
+
+            # Batch the items that are already waiting
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is STOP:
+                    done = True
+                    break
+                batch.append(item)
+
+            try:
+                self.handle(batch)
+            except Exception as e:
+                self.error = e
+                self.stopped.set()
+
+
+class Pipeline(object):
+    """Streams URLs through the category and trust stages and hands every
+    finished result row to on_result, from the stage threads"""
+
+    def __init__(self, on_result, workers=MAX_PARALLEL_REQUESTS,
+                 batch_size=URLS_PER_BATCH, queue_size=QUEUE_SIZE,
+                 category_limiter=None, trust_limiter=None, budget=None):
+        self.on_result = on_result
+        # Set to a metrics.Profiler to profile the stage threads
+        self.profiler = None
+        # Seconds all the upstream calls of a run may take, None for no limit
+        self.budget = budget
+        self.deadline = None
+        self.category_limiter = category_limiter
+        self.trust_limiter = trust_limiter
+        self.stopped = threading.Event()
+        self.trust = Stage(self.check_trust, self.stopped, workers,
+                           batch_size, queue_size)
+        self.category = Stage(self.check_category, self.stopped, workers,
+                              batch_size, queue_size)
+
+    def cancel(self):
+        self.stopped.set()
+
+    def wait(self):
+        # Wait for the batches that are still being classified
+        self.category.close()
+        self.trust.close()
+
+    def run(self, urls):
+        # Hand every URL to the category stage as soon as it arrives
+        if self.budget is not None:
+            self.deadline = Deadline(self.budget)
+        try:
+            for url in urls:
+                if self.stopped.is_set():
+                    break
+                self.category.put(url)
+        finally:
+            self.wait()
+        for stage in (self.category, self.trust):
+            if stage.error is not None:
+                raise stage.error
+
+    def profiling(self):
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.thread()
+
+    def limited(self):
+        # Upstream calls past the deadline of the run fall back at once
+        if self.deadline is None:
+            return nullcontext()
+        return deadline(self.deadline)
+
+    def paced(self, upstream, limiter):
+        # Every request to the upstream takes a token, while verdicts from
+        # the caches and the local model take none
+        if limiter is None:
+            return nullcontext()
+        return rate_limited(upstream, limiter)
+
+    def check_category(self, urls):
+        with self.profiling(), self.limited(), \
+                self.paced('openai', self.category_limiter), \
+                metrics.span('check_category'):
+            sources = {}
+            categories = check_categories(urls, sources=sources)
+        for url in urls:
+            row = category_row(url, categories[url], sources.get(url))
+            if categories[url]:
+                self.trust.put(row)
+            else:
+                self.on_result(row)
+
+    def check_trust(self, rows):
+        with self.profiling(), self.limited(), \
+                self.paced('safebrowsing', self.trust_limiter), \
+                metrics.span('check_url'):
+            statuses = check_urls([row['URL'] for row in rows])
+        for row in rows:
+            self.on_result(trust_row(row, statuses[row['URL']]))
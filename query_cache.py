@@ -0,0 +1,178 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from results_store import get_store
+from metrics import metrics
+
+QUERY_CACHE_FILENAME = 'query_cache.db'
+
+# Seconds the URLs of a search are reused for; result rankings drift slowly
+QUERY_TTL = 24 * 60 * 60
+# Least recently searched queries are evicted above this many queries
+MAX_QUERIES = 10000
+
+
+def query_key(query):
+    # Google ignores case and repeated spaces, so such queries share results
+    return ' '.join(query.lower().split())
+
+
+class QueryCache(object):
+    """On-disk cache of the result URLs of each search query"""
+
+    def __init__(self, path=QUERY_CACHE_FILENAME, ttl=QUERY_TTL,
+                 max_queries=MAX_QUERIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_queries = max_queries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # urls is NULL for queries that were searched but never finished;
+        # searches counts how often a query was asked for
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS queries (
+                query TEXT PRIMARY KEY,
+                urls TEXT,
+                exhausted INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL DEFAULT 0,
+                accessed REAL NOT NULL DEFAULT 0,
+                searches INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS queries_accessed ON queries (accessed);
+            CREATE TABLE IF NOT EXISTS warmed_until (
+                source TEXT PRIMARY KEY,
+                timestamp REAL NOT NULL
+            );
+        """)
+
+    def get(self, query, stop, count=True):
+        # The first stop URLs of a fresh search of the query, or None. Asking
+        # counts towards the popularity of the query unless count is False.
+        key = query_key(query)
+        now = time.time()
+        with self.lock:
+            if count:
+                self.db.execute(
+                    'INSERT INTO queries (query, accessed, searches) '
+                    'VALUES (?, ?, 1) ON CONFLICT (query) DO UPDATE '
+                    'SET accessed = excluded.accessed, searches = searches + 1',
+                    (key, now))
+                self.db.commit()
+            row = self.db.execute(
+                'SELECT urls, exhausted FROM queries '
+                'WHERE query = ? AND urls IS NOT NULL AND created >= ?',
+                (key, now - self.ttl)).fetchone()
+        urls = None
+        if row is not None:
+            cached = json.loads(row[0])
+            # A shorter list only answers when the search had no more results
+            if len(cached) >= stop or row[1]:
+                urls = cached[:stop]
+        metrics.count('query_cache_total', result='miss' if urls is None else 'hit')
+        return urls
+
+    def set(self, query, urls, exhausted=False, created=None):
+        # Keep the result URLs of a search; the popularity of the query stays
+        now = time.time()
+        created = now if created is None else created
+        key = query_key(query)
+        with self.lock:
+            self.db.execute(
+                'INSERT INTO queries (query, urls, exhausted, created, accessed) '
+                'VALUES (?, ?, ?, ?, ?) ON CONFLICT (query) DO UPDATE '
+                'SET urls = excluded.urls, exhausted = excluded.exhausted, '
+                'created = excluded.created',
+                (key, json.dumps(urls), int(exhausted), created, now))
+            self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        count = self.db.execute('SELECT COUNT(*) FROM queries').fetchone()[0]
+        if count > self.max_queries:
+            self.db.execute(
+                'DELETE FROM queries WHERE rowid IN (SELECT rowid FROM queries '
+                'ORDER BY accessed LIMIT ?)', (count - self.max_queries,))
+
+    def popular(self, n):
+        # The n most searched queries, with the time their URLs were fetched
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT query, created FROM queries '
+                'ORDER BY searches DESC, accessed DESC LIMIT ?', (n,))
+            return rows.fetchall()
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM queries')
+            self.db.commit()
+
+    def warm_from_history(self, store):
+        # Load the result URLs and popularity of the searches saved since the
+        # last warm-up
+        if not os.path.exists(store.path):
+            return
+        source = os.path.abspath(store.path)
+        with self.lock:
+            row = self.db.execute('SELECT timestamp FROM warmed_until '
+                                  'WHERE source = ?', (source,)).fetchone()
+        # Searches are appended in time order, so only the ones since the
+        # newest one already loaded are read; that one is read again, and
+        # loading it again changes nothing
+        if row is None:
+            history = store.searches()
+        else:
+            history = store.between(row[0], float('inf'))
+        if not history:
+            return
+
+        # The newest search of each query that went to Google wins; it ages
+        # from its own time. Searches answered from this cache only count
+        # towards popularity, as their URLs are as old as the cached ones.
+        searches = {}
+        accessed = {}
+        latest = {}
+        for search in history:
+            key = query_key(search['query'])
+            searches[key] = searches.get(key, 0) + 1
+            accessed[key] = max(accessed.get(key, 0), search['timestamp'])
+            if search.get('cached'):
+                continue
+            if key not in latest or search['timestamp'] >= latest[key]['timestamp']:
+                latest[key] = search
+        with self.lock:
+            for key in searches:
+                search = latest.get(key)
+                urls, created = None, 0
+                if search is not None:
+                    urls = json.dumps([r['URL'] for r in search['results']])
+                    created = search['timestamp']
+                self.db.execute(
+                    'INSERT INTO queries (query, urls, created, accessed, searches) '
+                    'VALUES (?, ?, ?, ?, ?) ON CONFLICT (query) DO UPDATE '
+                    'SET searches = max(searches, excluded.searches), '
+                    'urls = CASE WHEN created < excluded.created '
+                    'THEN excluded.urls ELSE urls END, '
+                    'exhausted = CASE WHEN created < excluded.created '
+                    'THEN 0 ELSE exhausted END, '
+                    'created = max(created, excluded.created)',
+                    (key, urls, created, accessed[key], searches[key]))
+            self._evict()
+            self.db.execute('INSERT OR REPLACE INTO warmed_until VALUES (?, ?)',
+                            (source, history[-1]['timestamp']))
+            self.db.commit()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_query_cache():
+    # Open the shared cache on first use and seed it from the search history
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = QueryCache()
+            _cache.warm_from_history(get_store())
+    return _cache
@@ -0,0 +1,55 @@
+import threading
+import time
+
+
+class RateLimiter(object):
+    """Token bucket allowing rate calls per second, in bursts of up to burst calls"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens=1):
+        # Wait until enough tokens are in the bucket, then take them
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """Token bucket that slows down when the upstream throttles and speeds
+    back up, step calls per second at a time, while it does not"""
+
+    def __init__(self, rate, burst=1, min_rate=None, max_rate=None, step=None):
+        super().__init__(rate, burst)
+        self.min_rate = float(min_rate if min_rate is not None else rate / 16)
+        self.max_rate = float(max_rate if max_rate is not None else rate)
+        self.step = float(step if step is not None else self.max_rate / 10)
+
+    def throttled(self, retry_after=None):
+        # Halve the rate and empty the bucket; waiting out retry_after seconds
+        # is owed as negative tokens
+        with self.lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+            wait = retry_after if retry_after is not None else 1 / self.rate
+            self.tokens = min(self.tokens, 0.0) - wait * self.rate
+
+    def succeeded(self):
+        with self.lock:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + self.step)
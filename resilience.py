@@ -0,0 +1,272 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from metrics import metrics, current_profiler
+
+# Settings of each upstream: seconds one call may take, retries of transient
+# errors, the base and cap of the backoff between them, the latency
+# percentile after which a duplicate request is sent, and the consecutive
+# failures that open the circuit and the seconds it stays open
+UPSTREAMS = {
+    'openai': {'timeout': 20.0, 'retries': 2, 'backoff': 0.5,
+               'max_backoff': 8.0, 'hedge_percentile': 95,
+               'failures': 5, 'reset_after': 30.0},
+    'safebrowsing': {'timeout': 5.0, 'retries': 2, 'backoff': 0.2,
+                     'max_backoff': 2.0, 'hedge_percentile': 95,
+                     'failures': 5, 'reset_after': 30.0},
+}
+# Seconds a whole search may spend waiting for the upstreams
+SEARCH_BUDGET = 60.0
+# Latencies kept to estimate the hedging threshold, and the number needed
+# before any request is hedged
+LATENCY_WINDOW = 200
+MIN_LATENCIES = 20
+# Threads running upstream calls, per upstream
+MAX_WORKERS = 16
+
+
+class UpstreamUnavailable(Exception):
+    """The upstream could not answer in time; callers fall back to a verdict
+    they already have or to an unknown one"""
+
+
+class Deadline(object):
+    """Point in time by which a piece of work has to finish"""
+
+    def __init__(self, seconds):
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+_local = threading.local()
+
+
+@contextmanager
+def deadline(budget):
+    # Bound every upstream call the current thread makes by the budget, a
+    # Deadline shared by the threads of one search
+    previous = getattr(_local, 'deadline', None)
+    _local.deadline = budget
+    try:
+        yield budget
+    finally:
+        _local.deadline = previous
+
+
+def current_deadline():
+    return getattr(_local, 'deadline', None)
+
+
+@contextmanager
+def rate_limited(name, limiter):
+    # Take a token of the limiter for every request the current thread sends
+    # to the upstream called name, retries and hedged duplicates included
+    previous = getattr(_local, 'limiters', {})
+    _local.limiters = dict(previous, **{name: limiter})
+    try:
+        yield limiter
+    finally:
+        _local.limiters = previous
+
+
+def current_limiter(name):
+    return getattr(_local, 'limiters', {}).get(name)
+
+
+def request_timeout(default):
+    # Seconds one HTTP request may take: default, or less when the current
+    # deadline ends sooner, so that a call that is given up on also ends
+    budget = current_deadline()
+    if budget is None:
+        return default
+    return max(0.001, min(default, budget.remaining()))
+
+
+def _run_within(budget, function, args):
+    with deadline(budget):
+        return function(*args)
+
+
+class CircuitBreaker(object):
+    """Stops calling an upstream after a run of failures, letting a single
+    trial call through once reset_after seconds have passed"""
+
+    def __init__(self, failures=5, reset_after=30.0):
+        self.max_failures = failures
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if self.trial or time.monotonic() - self.opened < self.reset_after:
+                return False
+            self.trial = True
+            return True
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def failed(self):
+        # Returns whether this failure opened the circuit
+        with self.lock:
+            self.failures += 1
+            was_open = self.opened is not None
+            if self.trial or self.failures >= self.max_failures:
+                self.opened = time.monotonic()
+            self.trial = False
+            return not was_open and self.opened is not None
+
+    def released(self):
+        # The trial call ended without telling whether the upstream is
+        # healthy, e.g. with an error of the request itself; let another
+        # call try instead
+        with self.lock:
+            self.trial = False
+
+    def is_open(self):
+        with self.lock:
+            return self.opened is not None
+
+
+class Upstream(object):
+    """Calls one upstream service within a deadline, hedging slow calls,
+    retrying transient errors and failing fast while it is unhealthy"""
+
+    def __init__(self, name, transient=(), timeout=20.0, retries=2,
+                 backoff=0.5, max_backoff=8.0, hedge_percentile=95,
+                 failures=5, reset_after=30.0):
+        self.name = name
+        self.transient = tuple(transient)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_percentile = hedge_percentile
+        self.breaker = CircuitBreaker(failures, reset_after)
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=MAX_WORKERS, thread_name_prefix=name)
+
+    def hedge_after(self):
+        # Seconds after which a call is slower than hedge_percentile of the
+        # recent ones, None while there are too few to tell
+        with self.lock:
+            if len(self.latencies) < MIN_LATENCIES:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1,
+                             int(len(latencies) * self.hedge_percentile / 100))]
+
+    def call(self, function, *args):
+        if not self.breaker.allow():
+            metrics.count('upstream_fallbacks_total', upstream=self.name,
+                          reason='circuit_open')
+            raise UpstreamUnavailable('%s is unavailable' % self.name)
+
+        budget = current_deadline()
+        for attempt in range(self.retries + 1):
+            timeout = self.timeout
+            if budget is not None:
+                timeout = min(timeout, budget.remaining())
+            if timeout <= 0:
+                metrics.count('upstream_fallbacks_total', upstream=self.name,
+                              reason='deadline')
+                raise UpstreamUnavailable('No time left to call %s' % self.name)
+
+            try:
+                result = self._call_hedged(function, args, timeout)
+            except self.transient + (UpstreamUnavailable,) as e:
+                if self.breaker.failed():
+                    metrics.count('circuit_opened_total', upstream=self.name)
+                if attempt == self.retries or self.breaker.is_open():
+                    metrics.count('upstream_fallbacks_total', upstream=self.name,
+                                  reason='errors')
+                    raise UpstreamUnavailable('%s failed: %s' % (self.name, e))
+                metrics.count('upstream_retries_total', upstream=self.name)
+                # Full jitter keeps the retries of many callers apart
+                pause = random.uniform(
+                    0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                if budget is not None:
+                    pause = min(pause, max(0.0, budget.remaining()))
+                time.sleep(pause)
+            except BaseException:
+                self.breaker.released()
+                raise
+            else:
+                self.breaker.succeeded()
+                return result
+
+    def _call_hedged(self, function, args, timeout):
+        # Run the call on the pool and send one duplicate if it is slow;
+        # the first answer wins and a call past the timeout is abandoned.
+        # The calls get the timeout as their deadline, which their requests
+        # take as theirs, and the pool threads are profiled with the caller.
+        function, args = _run_within, (Deadline(timeout), function, args)
+        profiler = current_profiler()
+        if profiler is not None:
+            function, args = profiler.call, (function,) + tuple(args)
+        limiter = current_limiter(self.name)
+        if limiter is not None:
+            limiter.acquire()
+        start = time.monotonic()
+        futures = [self.executor.submit(function, *args)]
+        hedge_after = self.hedge_after()
+        if hedge_after is not None and hedge_after < timeout:
+            done, _ = wait(futures, timeout=hedge_after)
+            if not done:
+                metrics.count('upstream_hedges_total', upstream=self.name)
+                if limiter is not None:
+                    limiter.acquire()
+                futures.append(self.executor.submit(function, *args))
+
+        error = None
+        while futures:
+            left = timeout - (time.monotonic() - start)
+            done, pending = wait(futures, timeout=max(0.0, left),
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    with self.lock:
+                        self.latencies.append(time.monotonic() - start)
+                    return future.result()
+                error = future.exception()
+            futures = list(pending)
+        if error is not None and not futures:
+            raise error
+        metrics.count('upstream_timeouts_total', upstream=self.name)
+        raise UpstreamUnavailable('%s did not answer within %.1fs'
+                                  % (self.name, timeout))
+
+
+_upstreams = {}
+_upstreams_lock = threading.Lock()
+
+
+def get_upstream(name, transient=()):
+    # One Upstream per service, shared by every caller so that they see the
+    # same latencies and circuit
+    with _upstreams_lock:
+        upstream = _upstreams.get(name)
+        if upstream is None:
+            upstream = _upstreams[name] = Upstream(
+                name, transient, **UPSTREAMS.get(name, {}))
+    return upstream
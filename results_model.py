@@ -0,0 +1,107 @@
+from PyQt5 import QtCore, QtGui
+
+COLUMNS = ('Searched URL', 'Category', 'Trusted')
+
+# Each row stores one status code instead of its two strings
+INFORMATION, TRUSTED, NOT_TRUSTED, PENDING, UNKNOWN, UNKNOWN_TRUST = range(6)
+STATUS_TEXT = {
+    INFORMATION: ("Information", ""),
+    TRUSTED: ("Shopping", "Yes"),
+    NOT_TRUSTED: ("Shopping", "No"),
+    PENDING: ("Shopping", ""),
+    UNKNOWN: ("Unknown", ""),
+    UNKNOWN_TRUST: ("Shopping", "Unknown"),
+}
+STATUS_COLORS = {
+    INFORMATION: (255, 255, 230),
+    TRUSTED: (230, 255, 230),
+    NOT_TRUSTED: (255, 230, 230),
+    PENDING: (255, 230, 230),
+    UNKNOWN: (235, 235, 235),
+    UNKNOWN_TRUST: (235, 235, 235),
+}
+
+
+def status_code(result):
+    if result['Category'] == "Unknown":
+        return UNKNOWN
+    if result['Category'] != "Shopping":
+        return INFORMATION
+    if result['Trusted'] == "Yes":
+        return TRUSTED
+    if result['Trusted'] == "No":
+        return NOT_TRUSTED
+    if result['Trusted'] == "Unknown":
+        return UNKNOWN_TRUST
+    return PENDING
+
+
+class ResultsModel(QtCore.QAbstractTableModel):
+    """Result rows kept as a column of URLs and a column of status codes"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.urls = []
+        self.statuses = bytearray()
+        # Brushes are made the first time a row of their colour is painted
+        self.brushes = {}
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.urls)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(COLUMNS)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
+            return COLUMNS[section]
+        return None
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row, column = index.row(), index.column()
+        status = self.statuses[row]
+        if role == QtCore.Qt.DisplayRole:
+            if column == 0:
+                return self.urls[row]
+            return STATUS_TEXT[status][column - 1]
+        if role == QtCore.Qt.BackgroundRole:
+            return self.brush(status)
+        if role == QtCore.Qt.UserRole and column == 0 and status == TRUSTED:
+            # Only trusted shops can be opened from the table
+            return QtCore.QUrl(self.urls[row])
+        return None
+
+    def brush(self, status):
+        brush = self.brushes.get(status)
+        if brush is None:
+            brush = self.brushes[status] = QtGui.QBrush(
+                QtGui.QColor(*STATUS_COLORS[status]))
+        return brush
+
+    def add_results(self, results):
+        # Insert many rows with one notification to the views
+        if not results:
+            return
+        first = len(self.urls)
+        self.beginInsertRows(QtCore.QModelIndex(), first, first + len(results) - 1)
+        for result in results:
+            self.urls.append(result['URL'])
+            self.statuses.append(status_code(result))
+        self.endInsertRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self.urls = []
+        self.statuses = bytearray()
+        self.endResetModel()
+
+
+class ResultsFilter(QtCore.QSortFilterProxyModel):
+    """Sorts the results by any column and keeps the rows containing a text"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setFilterKeyColumn(-1)
+        self.setFilterCaseSensitivity(QtCore.Qt.CaseInsensitive)
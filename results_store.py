@@ -0,0 +1,311 @@
+import bisect
+import json
+import os
+import sqlite3
+import threading
+import time
+
+RESULTS_FILENAME = 'search_results.jsonl'
+# Searches saved by older versions, imported once into a new store
+LEGACY_FILENAME = 'search_results.json'
+# Number of appends between checks for a compaction of the store
+COMPACT_EVERY = 100
+# Share of free pages above which a SQLite store is rewritten
+FREE_PAGES_SHARE = 0.25
+
+
+class JsonlResultsStore(object):
+    """Append-only log of searches, one JSON object per line, indexed in memory"""
+
+    def __init__(self, path, keep=None):
+        self.path = path
+        # Maximum number of searches kept by a compaction, None keeps all
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.appends = 0
+        self._index()
+
+    def _index(self):
+        # Remember where each search starts in the file, by query, URL and time
+        self.offsets = []
+        self.timestamps = []
+        self.by_query_index = {}
+        self.by_url_index = {}
+        self.garbage = 0
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'rb+') as f:
+            offset = 0
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # An append that was cut off by a crash; drop it so the
+                    # next search starts on a line of its own
+                    f.truncate(offset)
+                    break
+                try:
+                    search = json.loads(line)
+                except ValueError:
+                    self.garbage += 1
+                else:
+                    self._add(offset, search)
+                offset += len(line)
+
+    def _add(self, offset, search):
+        position = len(self.offsets)
+        self.offsets.append(offset)
+        self.timestamps.append(search['timestamp'])
+        self.by_query_index.setdefault(search['query'], []).append(position)
+        for result in search['results']:
+            positions = self.by_url_index.setdefault(result['URL'], [])
+            if not positions or positions[-1] != position:
+                positions.append(position)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, query, results, timestamp=None, cached=False):
+        # cached marks a search answered from the query cache, not by Google
+        search = {'query': query,
+                  'timestamp': time.time() if timestamp is None else timestamp,
+                  'results': results}
+        if cached:
+            search['cached'] = True
+        line = (json.dumps(search) + '\n').encode('utf-8')
+        with self.lock:
+            with open(self.path, 'ab') as f:
+                offset = f.tell()
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._add(offset, search)
+            self.appends += 1
+            if self.appends % COMPACT_EVERY == 0 and self._needs_compaction():
+                self._compact()
+        return search
+
+    def _read(self, positions):
+        searches = []
+        with open(self.path, 'rb') as f:
+            for position in positions:
+                f.seek(self.offsets[position])
+                searches.append(json.loads(f.readline()))
+        return searches
+
+    def searches(self):
+        with self.lock:
+            return self._read(range(len(self.offsets)))
+
+    def by_query(self, query):
+        with self.lock:
+            return self._read(self.by_query_index.get(query, []))
+
+    def by_url(self, url):
+        with self.lock:
+            return self._read(self.by_url_index.get(url, []))
+
+    def between(self, start, end):
+        # Searches are appended in time order, so the timestamps are sorted
+        with self.lock:
+            first = bisect.bisect_left(self.timestamps, start)
+            last = bisect.bisect_right(self.timestamps, end)
+            return self._read(range(first, last))
+
+    def _needs_compaction(self):
+        return self.garbage > 0 or (self.keep is not None and
+                                    len(self.offsets) > self.keep)
+
+    def compact(self):
+        with self.lock:
+            self._compact()
+
+    def _compact(self):
+        # Rewrite the log without broken lines and searches over the limit,
+        # replacing the old file only once the new one is complete
+        positions = range(len(self.offsets))
+        if self.keep is not None:
+            positions = positions[max(0, len(positions) - self.keep):]
+        searches = self._read(positions)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for search in searches:
+                f.write(json.dumps(search) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._index()
+
+    def close(self):
+        pass
+
+
+class SqliteResultsStore(object):
+    """SQLite store of searches with indexes by query, URL and time"""
+
+    def __init__(self, path, keep=None):
+        self.path = path
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.appends = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS searches (
+                id INTEGER PRIMARY KEY,
+                query TEXT NOT NULL,
+                timestamp REAL NOT NULL,
+                cached INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS results (
+                search_id INTEGER NOT NULL REFERENCES searches (id),
+                position INTEGER NOT NULL,
+                url TEXT NOT NULL,
+                category TEXT NOT NULL,
+                trusted TEXT NOT NULL,
+                source TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY (search_id, position)
+            );
+            CREATE INDEX IF NOT EXISTS searches_query ON searches (query);
+            CREATE INDEX IF NOT EXISTS searches_timestamp ON searches (timestamp);
+            CREATE INDEX IF NOT EXISTS results_url ON results (url);
+        """)
+        # Stores made before searches recorded cache hits and results where
+        # their category came from
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(searches)')]
+        if 'cached' not in columns:
+            self.db.execute("ALTER TABLE searches "
+                            "ADD COLUMN cached INTEGER NOT NULL DEFAULT 0")
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(results)')]
+        if 'source' not in columns:
+            self.db.execute("ALTER TABLE results "
+                            "ADD COLUMN source TEXT NOT NULL DEFAULT ''")
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM searches').fetchone()[0]
+
+    def append(self, query, results, timestamp=None, cached=False):
+        # cached marks a search answered from the query cache, not by Google
+        search = {'query': query,
+                  'timestamp': time.time() if timestamp is None else timestamp,
+                  'results': results}
+        if cached:
+            search['cached'] = True
+        with self.lock:
+            with self.db:
+                search_id = self.db.execute(
+                    'INSERT INTO searches (query, timestamp, cached) '
+                    'VALUES (?, ?, ?)',
+                    (query, search['timestamp'], int(cached))).lastrowid
+                self.db.executemany(
+                    'INSERT INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                    [(search_id, i, r['URL'], r['Category'], r['Trusted'],
+                      r.get('Source', '')) for i, r in enumerate(results)])
+            self.appends += 1
+            if self.appends % COMPACT_EVERY == 0 and self._needs_compaction():
+                self._compact()
+        return search
+
+    def _select(self, where='', params=()):
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT id, query, timestamp, cached FROM searches ' + where +
+                ' ORDER BY id', params).fetchall()
+            searches = []
+            for search_id, query, timestamp, cached in rows:
+                results = self.db.execute(
+                    'SELECT url, category, trusted, source FROM results '
+                    'WHERE search_id = ? ORDER BY position', (search_id,))
+                search = {'query': query, 'timestamp': timestamp,
+                          'results': [result_row(*row) for row in results]}
+                if cached:
+                    search['cached'] = True
+                searches.append(search)
+            return searches
+
+    def searches(self):
+        return self._select()
+
+    def by_query(self, query):
+        return self._select('WHERE query = ?', (query,))
+
+    def by_url(self, url):
+        return self._select(
+            'WHERE id IN (SELECT search_id FROM results WHERE url = ?)', (url,))
+
+    def between(self, start, end):
+        return self._select('WHERE timestamp BETWEEN ? AND ?', (start, end))
+
+    def compact(self):
+        with self.lock:
+            self._compact()
+
+    def _needs_compaction(self):
+        # Searches over the limit, or many pages left free by deletions; ids
+        # only grow, so their range bounds the number of searches
+        if self.keep is not None:
+            first, last = self.db.execute(
+                'SELECT min(id), max(id) FROM searches').fetchone()
+            if first is not None and last - first + 1 > self.keep:
+                return True
+        free = self.db.execute('PRAGMA freelist_count').fetchone()[0]
+        pages = self.db.execute('PRAGMA page_count').fetchone()[0]
+        return free > pages * FREE_PAGES_SHARE
+
+    def _compact(self):
+        # Drop the searches over the limit and give the free pages back
+        if self.keep is not None:
+            with self.db:
+                self.db.execute(
+                    'DELETE FROM searches WHERE id NOT IN '
+                    '(SELECT id FROM searches ORDER BY id DESC LIMIT ?)',
+                    (self.keep,))
+                self.db.execute(
+                    'DELETE FROM results WHERE search_id NOT IN '
+                    '(SELECT id FROM searches)')
+        self.db.execute('VACUUM')
+
+    def close(self):
+        self.db.close()
+
+
+def result_row(url, category, trusted, source):
+    # Rows only carry a source when the local model categorized them
+    row = {'URL': url, 'Category': category, 'Trusted': trusted}
+    if source:
+        row['Source'] = source
+    return row
+
+
+def open_store(path=RESULTS_FILENAME, keep=None, legacy=LEGACY_FILENAME):
+    # Pick the backend from the file extension, and import the searches of
+    # the old JSON file when the store is created
+    new = not os.path.exists(path)
+    if path.endswith(('.db', '.sqlite', '.sqlite3')):
+        store = SqliteResultsStore(path, keep)
+    else:
+        store = JsonlResultsStore(path, keep)
+    if new and legacy and os.path.isfile(legacy):
+        migrate_json(store, legacy)
+    return store
+
+
+def migrate_json(store, filename=LEGACY_FILENAME):
+    # The old file has no timestamps, so its searches get the file's mtime
+    with open(filename, 'r') as f:
+        data = json.load(f)
+    timestamp = os.path.getmtime(filename)
+    for search in data:
+        store.append(search['query'], search['results'], timestamp)
+    return len(data)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    # Open the shared results store on first use
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = open_store()
+    return _store
@@ -0,0 +1,417 @@
+import base64
+import hashlib
+import json
+import os
+import random
+import re
+import socket
+import threading
+import time
+from urllib.parse import unquote_to_bytes
+
+from metrics import metrics
+from resilience import request_timeout
+
+API_BASE = 'https://safebrowsing.googleapis.com/v4'
+DB_DIRECTORY = 'safebrowsing_db'
+CLIENT = {"clientId": "pysafebrowsing", "clientVersion": "0.1"}
+# Threat lists kept locally, as (threatType, platformType, threatEntryType)
+THREAT_LISTS = [
+    ("MALWARE", "ANY_PLATFORM", "URL"),
+    ("SOCIAL_ENGINEERING", "ANY_PLATFORM", "URL"),
+    ("UNWANTED_SOFTWARE", "ANY_PLATFORM", "URL"),
+    ("POTENTIALLY_HARMFUL_APPLICATION", "ANY_PLATFORM", "URL"),
+]
+# Time between updates when the server does not ask for a longer wait
+UPDATE_INTERVAL = 30 * 60
+# Lists that have not been updated for this long are not trusted anymore
+STALE_AFTER = 6 * 60 * 60
+# Seconds a request may take outside of an upstream deadline, e.g. an update
+REQUEST_TIMEOUT = 60
+
+
+class DatabaseUnavailable(Exception):
+    """The local threat lists are missing, incomplete or too old to answer
+    lookups"""
+
+
+def _unescape(url):
+    # Percent-unescape the URL until it does not change anymore
+    data = url.encode('utf-8')
+    while True:
+        unescaped = unquote_to_bytes(data)
+        if unescaped == data:
+            return data.decode('latin-1')
+        data = unescaped
+
+
+def _escape(url):
+    return ''.join('%%%02X' % ord(c) if ord(c) <= 32 or ord(c) >= 127 or
+                   c in '#%' else c for c in url)
+
+
+def _normalize_ip(host):
+    # Hosts like 0x7f.1 or 2130706433 are written as dotted decimal addresses
+    if not re.match(r'^(0x[0-9a-f]*|[0-9]+)(\.(0x[0-9a-f]*|[0-9]+)){0,3}$', host):
+        return None
+    try:
+        return socket.inet_ntoa(socket.inet_aton(host))
+    except OSError:
+        return None
+
+
+def _normalize_path(path):
+    if not path:
+        return '/'
+    trailing = path.endswith(('/', '/.', '/..'))
+    segments = []
+    for segment in path.split('/'):
+        if segment in ('', '.'):
+            continue
+        if segment == '..':
+            if segments:
+                segments.pop()
+            continue
+        segments.append(segment)
+    path = '/' + '/'.join(segments)
+    if trailing and segments:
+        path += '/'
+    return path
+
+
+def canonicalize(url):
+    # Canonicalize a URL the way the Safe Browsing API expects before hashing
+    url = re.sub(r'[\t\r\n]', '', url.strip())
+    url = _unescape(url.split('#', 1)[0])
+    if '://' not in url:
+        url = 'http://' + url
+    scheme, rest = url.split('://', 1)
+    hostport, path = re.match(r'([^/?]*)(.*)', rest).groups()
+    host = hostport.rsplit('@', 1)[-1].split(':', 1)[0]
+    # Only ASCII letters are lowercased, other bytes are kept as they are
+    host = re.sub(r'\.+', '.', host.strip('.')).encode('latin-1').lower()
+    host = host.decode('latin-1')
+    host = _normalize_ip(host) or host
+    path, sep, query = path.partition('?')
+    return _escape('%s://%s%s%s%s' % (scheme.lower(), host,
+                                      _normalize_path(path), sep, query))
+
+
+def expressions(url):
+    # The host suffix / path prefix combinations of a URL that are hashed
+    rest = canonicalize(url).split('://', 1)[1]
+    host, _, path = rest.partition('/')
+    path = '/' + path
+
+    hosts = [host]
+    if _normalize_ip(host) is None:
+        labels = host.split('.')
+        for k in range(min(len(labels) - 1, 5), 1, -1):
+            hosts.append('.'.join(labels[-k:]))
+
+    exact, sep, _ = path.partition('?')
+    paths = [path, exact] if sep else [exact]
+    prefix = '/'
+    paths.append(prefix)
+    for segment in exact.split('/')[1:-1][:3]:
+        prefix += segment + '/'
+        paths.append(prefix)
+
+    return list(dict.fromkeys(h + p for h in hosts for p in paths))
+
+
+def full_hashes(url):
+    return [hashlib.sha256(e.encode('latin-1')).digest()
+            for e in expressions(url)]
+
+
+def _seconds(duration):
+    # Durations are sent as strings like "300.5s"
+    return float(duration.rstrip('s')) if duration else 0.0
+
+
+def _contains(blob, size, prefix):
+    # Binary search in a sorted blob of fixed-size hash prefixes
+    lo, hi = 0, len(blob) // size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        item = blob[mid * size:(mid + 1) * size]
+        if item < prefix:
+            lo = mid + 1
+        elif item > prefix:
+            hi = mid
+        else:
+            return True
+    return False
+
+
+class ThreatList(object):
+    """Hash prefixes of one threat list, one sorted blob per prefix size"""
+
+    def __init__(self, key):
+        self.key = key
+        self.state = ''
+        self.blobs = {}
+
+    @property
+    def name(self):
+        return '_'.join(self.key)
+
+    def prefixes(self):
+        # All prefixes in lexicographic order, which removal indices refer to
+        prefixes = []
+        for size, blob in self.blobs.items():
+            prefixes.extend(blob[i:i + size] for i in range(0, len(blob), size))
+        prefixes.sort()
+        return prefixes
+
+    def set_prefixes(self, prefixes):
+        groups = {}
+        for prefix in prefixes:
+            groups.setdefault(len(prefix), []).append(prefix)
+        self.blobs = dict((size, b''.join(sorted(group)))
+                          for size, group in groups.items())
+
+    def matches(self, full_hash):
+        return [full_hash[:size] for size, blob in self.blobs.items()
+                if _contains(blob, size, full_hash[:size])]
+
+    def reset(self):
+        self.state = ''
+        self.blobs = {}
+
+
+class SafeBrowsingDatabase(object):
+    """Local copy of the Safe Browsing threat lists, kept current with the
+    Update API; only URLs matching a hash prefix are confirmed online"""
+
+    def __init__(self, key, directory=DB_DIRECTORY, api_base=API_BASE,
+                 lists=THREAT_LISTS, session=None):
+        self.api_key = key
+        self.directory = directory
+        self.api_base = api_base
+        if session is None:
+            import requests
+            session = requests.Session()
+        self.session = session
+        self.lists = dict((tuple(k), ThreatList(tuple(k))) for k in lists)
+        self.lock = threading.RLock()
+        self.next_update = 0.0
+        self.last_update = 0.0
+        self.errors = 0
+        # Whether an update is running on the background thread
+        self.updating = False
+        # Full hashes known to be unsafe and prefixes known to be safe,
+        # each with the time they expire
+        self.positive_cache = {}
+        self.negative_cache = {}
+        self.load()
+
+    def load(self):
+        state_filename = os.path.join(self.directory, 'state.json')
+        if not os.path.isfile(state_filename):
+            return
+        with open(state_filename, 'r') as f:
+            state = json.load(f)
+        self.next_update = state['next_update']
+        self.last_update = state['last_update']
+        for threat_list in self.lists.values():
+            saved = state['lists'].get(threat_list.name)
+            if saved is None:
+                continue
+            threat_list.state = saved['state']
+            for size in saved['sizes']:
+                filename = os.path.join(self.directory, '%s.%d' %
+                                        (threat_list.name, size))
+                with open(filename, 'rb') as f:
+                    threat_list.blobs[size] = f.read()
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        lists = {}
+        for threat_list in self.lists.values():
+            for size, blob in threat_list.blobs.items():
+                self._write(os.path.join(self.directory, '%s.%d' %
+                                         (threat_list.name, size)), blob)
+            lists[threat_list.name] = {'state': threat_list.state,
+                                       'sizes': sorted(threat_list.blobs)}
+        state = {'next_update': self.next_update,
+                 'last_update': self.last_update, 'lists': lists}
+        self._write(os.path.join(self.directory, 'state.json'),
+                    json.dumps(state).encode('utf-8'))
+
+    def _write(self, filename, data):
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_filename, filename)
+
+    def _post(self, method, body):
+        metrics.count('upstream_requests_total', upstream='safebrowsing')
+        r = self.session.post(self.api_base + '/' + method,
+                              params={'key': self.api_key},
+                              data=json.dumps(body),
+                              headers={'Content-type': 'application/json'},
+                              timeout=request_timeout(REQUEST_TIMEOUT))
+        r.raise_for_status()
+        return r.json()
+
+    def _back_off(self):
+        # Wait exponentially longer after each failed update
+        self.errors += 1
+        self.next_update = time.time() + min(
+            24 * 60 * 60, 15 * 60 * 2 ** (self.errors - 1) * (1 + random.random()))
+
+    def update(self):
+        # Fetch the changes to every list since its last client state; the
+        # lists stay usable for lookups while the response is awaited
+        import requests
+        with self.lock:
+            body = {
+                "client": CLIENT,
+                "listUpdateRequests": [{
+                    "threatType": k[0], "platformType": k[1],
+                    "threatEntryType": k[2], "state": l.state,
+                    "constraints": {"supportedCompressions": ["RAW"]},
+                } for k, l in self.lists.items()]
+            }
+        try:
+            response = self._post('threatListUpdates:fetch', body)
+        except (requests.RequestException, ValueError):
+            with self.lock:
+                self._back_off()
+            raise
+
+        with self.lock:
+            applied = [self._apply(list_update)
+                       for list_update in response.get('listUpdateResponses', [])]
+            now = time.time()
+            if all(applied):
+                self.errors = 0
+                self.last_update = now
+                self.next_update = now + max(
+                    UPDATE_INTERVAL, _seconds(response.get('minimumWaitDuration')))
+            elif self.errors == 0:
+                # A list was reset by a checksum mismatch; fetch it in full
+                # right away, but back off if that keeps happening
+                self.errors += 1
+                self.next_update = now
+            else:
+                self._back_off()
+            # Cached full hashes may be outdated by the new lists
+            self.negative_cache.clear()
+            self.save()
+
+    def _apply(self, list_update):
+        # Returns False when the list had to be reset
+        key = (list_update['threatType'], list_update['platformType'],
+               list_update['threatEntryType'])
+        threat_list = self.lists.get(key)
+        if threat_list is None:
+            return True
+        if list_update['responseType'] == 'FULL_UPDATE':
+            prefixes = []
+        else:
+            prefixes = threat_list.prefixes()
+
+        removed = set()
+        for removal in list_update.get('removals', []):
+            removed.update(removal['rawIndices']['indices'])
+        if removed:
+            prefixes = [p for i, p in enumerate(prefixes) if i not in removed]
+        for addition in list_update.get('additions', []):
+            raw = addition['rawHashes']
+            size = raw['prefixSize']
+            data = base64.b64decode(raw['rawHashes'])
+            prefixes.extend(data[i:i + size] for i in range(0, len(data), size))
+        prefixes.sort()
+
+        # Start over with a full update when the list does not match the server
+        checksum = list_update.get('checksum', {}).get('sha256')
+        if checksum and base64.b64decode(checksum) != \
+                hashlib.sha256(b''.join(prefixes)).digest():
+            threat_list.reset()
+            return False
+        threat_list.set_prefixes(prefixes)
+        threat_list.state = list_update['newClientState']
+        return True
+
+    def update_if_due(self):
+        # Start an update on a background thread when one is due, so that
+        # lookups never wait for the Update API
+        with self.lock:
+            if time.time() >= self.next_update and not self.updating:
+                self.updating = True
+                threading.Thread(target=self._update_in_background,
+                                 daemon=True).start()
+            if time.time() - self.last_update > STALE_AFTER:
+                raise DatabaseUnavailable(
+                    'The Safe Browsing threat lists could not be updated')
+            # A list without a client state was never fetched or was reset,
+            # so it would pass every URL as clean
+            if any(not l.state for l in self.lists.values()):
+                raise DatabaseUnavailable(
+                    'The Safe Browsing threat lists are incomplete')
+
+    def _update_in_background(self):
+        import requests
+        try:
+            self.update()
+        except (requests.RequestException, ValueError):
+            pass
+        finally:
+            with self.lock:
+                self.updating = False
+
+    def lookup_urls(self, urls):
+        # Return a dict of URL to whether it is on one of the threat lists
+        self.update_if_due()
+        now = time.time()
+        url_hashes = dict((url, full_hashes(url)) for url in urls)
+
+        # Only prefixes without a fresh cached answer need to be confirmed;
+        # a full hash that was unsafe is asked about again once that answer
+        # expires, however fresh the safe answer for its prefix
+        unconfirmed = set()
+        with self.lock:
+            for hashes in url_hashes.values():
+                for full_hash in hashes:
+                    unsafe_until = self.positive_cache.get(full_hash)
+                    if unsafe_until is not None and unsafe_until > now:
+                        continue
+                    for threat_list in self.lists.values():
+                        for prefix in threat_list.matches(full_hash):
+                            if unsafe_until is not None or \
+                                    self.negative_cache.get(prefix, 0) <= now:
+                                unconfirmed.add(prefix)
+        if unconfirmed:
+            self.find_full_hashes(unconfirmed)
+
+        with self.lock:
+            return dict((url, any(self.positive_cache.get(h, 0) > now
+                                  for h in hashes))
+                        for url, hashes in url_hashes.items())
+
+    def find_full_hashes(self, prefixes):
+        body = {
+            "client": CLIENT,
+            "clientStates": [l.state for l in self.lists.values()],
+            "threatInfo": {
+                "threatTypes": sorted(set(k[0] for k in self.lists)),
+                "platformTypes": sorted(set(k[1] for k in self.lists)),
+                "threatEntryTypes": sorted(set(k[2] for k in self.lists)),
+                "threatEntries": [{"hash": base64.b64encode(p).decode('ascii')}
+                                  for p in sorted(prefixes)],
+            }
+        }
+        response = self._post('fullHashes:find', body)
+        now = time.time()
+        with self.lock:
+            for match in response.get('matches', []):
+                full_hash = base64.b64decode(match['threat']['hash'])
+                self.positive_cache[full_hash] = now + \
+                    _seconds(match.get('cacheDuration'))
+            negative_until = now + \
+                _seconds(response.get('negativeCacheDuration'))
+            for prefix in prefixes:
+                self.negative_cache[prefix] = negative_until
@@ -0,0 +1,216 @@
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+from pipeline import category_row, trust_row
+from config import get_credentials
+from shopping_classifier import check_categories
+from trust_classifier import check_urls
+from verdict_cache import get_cache
+from url_canon import normalize_url
+from metrics import metrics
+from transport import get_transport
+
+# Upstream calls each service runs at the same time
+OPENAI_CONCURRENCY = 4
+SAFEBROWSING_CONCURRENCY = 4
+# Largest number of URLs accepted by one request
+MAX_BATCH = 500
+
+
+def timed(stage, function, urls):
+    with metrics.span(stage):
+        return function(urls)
+
+
+def categories_and_sources(urls):
+    # The category of each URL with the source of local answers, if any
+    sources = {}
+    categories = check_categories(urls, sources=sources)
+    return dict((url, (categories[url], sources.get(url))) for url in urls)
+
+
+class SingleFlight(object):
+    """Lets concurrent callers asking for the same keys share one in-flight call"""
+
+    def __init__(self, key=normalize_url):
+        self.key = key
+        self.calls = {}
+        self.tasks = set()
+
+    def in_flight(self):
+        return len(self.calls)
+
+    async def do_many(self, urls, call):
+        # call(urls) returns a dict of URL to result; it only gets the URLs
+        # that no other caller is already waiting for
+        loop = asyncio.get_running_loop()
+        keys = dict((url, self.key(url)) for url in urls)
+        owned = {}
+        for url, key in keys.items():
+            if key not in self.calls and key not in owned:
+                owned[key] = url
+                self.calls[key] = loop.create_future()
+        futures = dict((url, self.calls[key]) for url, key in keys.items())
+
+        # The call runs in a task of its own, so a caller that goes away,
+        # e.g. a client that disconnects, does not cancel it for the others
+        if owned:
+            task = asyncio.ensure_future(self.settle(owned, call))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+        values = await asyncio.gather(
+            *(asyncio.shield(future) for future in futures.values()))
+        return dict(zip(futures.keys(), values))
+
+    async def settle(self, owned, call):
+        # Resolve the futures of the owned keys with the results of the call
+        try:
+            results = await call(list(owned.values()))
+        except asyncio.CancelledError:
+            for key in owned:
+                self.calls[key].cancel()
+            raise
+        except Exception as e:
+            for key in owned:
+                self.calls[key].set_exception(e)
+        else:
+            for key, url in owned.items():
+                self.calls[key].set_result(results[url])
+        finally:
+            for key in owned:
+                del self.calls[key]
+
+
+class ClassificationService(object):
+    """Classifies URLs for many clients, sharing upstream calls and quota"""
+
+    def __init__(self, openai_concurrency=OPENAI_CONCURRENCY,
+                 safebrowsing_concurrency=SAFEBROWSING_CONCURRENCY):
+        self.openai = asyncio.Semaphore(openai_concurrency)
+        self.safebrowsing = asyncio.Semaphore(safebrowsing_concurrency)
+        self.executor = ThreadPoolExecutor(
+            max_workers=openai_concurrency + safebrowsing_concurrency)
+        # Requests share calls per URL; the classifiers fan a verdict out to
+        # the other URLs of its domain themselves, after the overrides and
+        # the per-URL cache
+        self.categories = SingleFlight()
+        self.statuses = SingleFlight()
+
+    async def run(self, semaphore, stage, function, urls):
+        # The classifiers block, so they run on the executor's threads
+        async with semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self.executor, timed, stage, function, urls)
+
+    async def check_categories(self, urls):
+        return await self.run(self.openai, 'check_category',
+                              categories_and_sources, urls)
+
+    async def check_urls(self, urls):
+        return await self.run(self.safebrowsing, 'check_url', check_urls, urls)
+
+    async def classify(self, urls):
+        urls = list(dict.fromkeys(urls))
+        categories = await self.categories.do_many(urls, self.check_categories)
+        statuses = await self.statuses.do_many(
+            [url for url in urls if categories[url][0]], self.check_urls)
+
+        results = []
+        for url in urls:
+            row = category_row(url, *categories[url])
+            if categories[url][0]:
+                row = trust_row(row, statuses[url])
+            results.append(row)
+        return results
+
+    async def handle_classify(self, request):
+        try:
+            body = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(text='The body must be JSON')
+        if not isinstance(body, dict):
+            raise web.HTTPBadRequest(text='The body must be a JSON object')
+
+        # Accept {"url": "..."} for one URL and {"urls": [...]} for a batch
+        if isinstance(body.get('url'), str):
+            results = await self.classify([body['url']])
+            return web.json_response(results[0])
+        urls = body.get('urls')
+        if not isinstance(urls, list) or not all(isinstance(u, str) for u in urls):
+            raise web.HTTPBadRequest(text='Send a "url" string or a "urls" list')
+        if len(urls) > MAX_BATCH:
+            raise web.HTTPRequestEntityTooLarge(MAX_BATCH, len(urls))
+        results = dict((row['URL'], row) for row in await self.classify(urls))
+        return web.json_response({'results': [results[url] for url in urls]})
+
+    async def handle_health(self, request):
+        return web.json_response({'status': 'ok'})
+
+    async def handle_ready(self, request):
+        # Ready once the credentials and the verdict cache can be used
+        loop = asyncio.get_running_loop()
+        try:
+            ready = await loop.run_in_executor(self.executor, self.check_ready)
+        except Exception as e:
+            ready = False
+            reason = str(e)
+        else:
+            reason = '' if ready else 'Missing API credentials'
+        status = {
+            'status': 'ready' if ready else 'not ready',
+            'in_flight': {'category': self.categories.in_flight(),
+                          'trust': self.statuses.in_flight()},
+        }
+        if reason:
+            status['reason'] = reason
+        return web.json_response(status, status=200 if ready else 503)
+
+    async def handle_metrics(self, request):
+        return web.Response(text=metrics.prometheus() + get_transport().prometheus(),
+                            content_type='text/plain', charset='utf-8')
+
+    async def handle_transport(self, request):
+        # Connection pool statistics, for tuning the pool sizes under load
+        return web.json_response(get_transport().stats())
+
+    def check_ready(self):
+        get_cache()
+        return bool(get_credentials("openai")) and \
+            bool(get_credentials("google_safe"))
+
+    def app(self):
+        app = web.Application()
+        app.add_routes([
+            web.post('/classify', self.handle_classify),
+            web.get('/healthz', self.handle_health),
+            web.get('/readyz', self.handle_ready),
+            web.get('/metrics', self.handle_metrics),
+            web.get('/transport', self.handle_transport),
+        ])
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve URL classification over HTTP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--openai-concurrency', type=int,
+                        default=OPENAI_CONCURRENCY)
+    parser.add_argument('--safebrowsing-concurrency', type=int,
+                        default=SAFEBROWSING_CONCURRENCY)
+    args = parser.parse_args()
+
+    async def create_app():
+        # The semaphores belong to the event loop the app runs on
+        return ClassificationService(args.openai_concurrency,
+                                     args.safebrowsing_concurrency).app()
+
+    web.run_app(create_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,44 +1,86 @@
-import openai
-import json
-
-
-def get_credentials(key):
-    with open("credentials.json", 'r') as json_file:
-        data = json.load(json_file)
-        return find_key_value(data, key)
-
-def find_key_value(data, key):
-    if isinstance(data, dict):
-        for k, v in data.items():
-            if k == key:
-                return v
-            elif isinstance(v, (dict, list)):
-                result = find_key_value(v, key)
-                if result is not None:
-                    return result
-    elif isinstance(data, list):
-        for item in data:
-            result = find_key_value(item, key)
-            if result is not None:
-                return result
-
-    return None
-
-# Set up OpenAI API credentials
-openai.api_key = get_credentials("openai")
+import re
+import threading
+from config import get_credentials, find_key_value
+from transport import get_transport
+from verdict_sharing import resolve_verdicts, fallback_verdicts
+from url_model import get_model
+from resilience import get_upstream, request_timeout, UpstreamUnavailable
+from metrics import metrics
+
 model_engine = "text-davinci-002"
 
+# The answer is a single word, so a few tokens are enough for one URL
+MAX_TOKENS = 5
+# Tokens needed for one "<number>: <category>" line of a batched answer
+TOKENS_PER_URL = 8
+# Number of URLs classified by a single batched prompt
+BATCH_SIZE = 20
+# Seconds a completion request may take outside of an upstream deadline
+REQUEST_TIMEOUT = 60
+
+# Matches one line of a batched answer, taking the category at the end of the
+# line in case the model echoes a URL that contains one of the words
+ANSWER_LINE = re.compile(r'^\W*(\d+)\b.*\b(shopping|information)\W*$', re.I)
+
+_openai = None
+_openai_lock = threading.Lock()
+
+# Function to import the OpenAI library and set up its credentials on first use
+def get_openai():
+    global _openai
+    with _openai_lock:
+        if _openai is None:
+            import openai
+            openai.api_key = get_credentials("openai")
+            get_transport().patch_openai(openai)
+            _openai = openai
+    return _openai
+
+# Function to list the errors of the OpenAI API that are worth trying again
+def transient_errors():
+    error = get_openai().error
+    return (
+        error.Timeout,
+        error.TryAgain,
+        error.APIConnectionError,
+        error.APIError,
+        error.RateLimitError,
+        error.ServiceUnavailableError,
+    )
+
 # Function to check if a given URL belongs to a shopping category
 def check_category(url):
+    return check_categories([url])[url]
+
+# Function to classify the URLs the local model is confident about
+def predict_categories(urls):
+    model = get_model()
+    if model is None:
+        return {}
+    predictions = {}
+    for url in urls:
+        is_shopping = model.predict(url)
+        if is_shopping is not None:
+            predictions[url] = is_shopping
+    # Count the URLs answered by the local model and the ones left for the LLM
+    metrics.count('category_answers_total', len(predictions), source='local')
+    metrics.count('category_answers_total', len(urls) - len(predictions),
+                  source='llm')
+    return predictions
+
+# Function to ask the OpenAI API for the category of a URL, None if it gave no answer
+def ask_category(url, max_tokens=MAX_TOKENS):
     # Set the prompt for the OpenAI API request
+    metrics.count('upstream_requests_total', upstream='openai')
     prompt = f"Please classify the category of the URL as 'shopping' or 'information' in just one word {url}."
-    completions = openai.Completion.create(
+    completions = get_openai().Completion.create(
         engine=model_engine,
         prompt=prompt,
-        max_tokens=1024,
+        max_tokens=max_tokens,
         n=1,
         stop=None,
         temperature=0.5,
+        request_timeout=request_timeout(REQUEST_TIMEOUT),
     )
 
     # Check if the API response contains any choices
@@ -51,7 +93,96 @@ def check_category(url):
         else:
             return False
     else:
-        return False
+        return None
+
+# Function to classify a whole page of URLs, returning a dict of URL to
+# is_shopping, which is None when OpenAI was unavailable and nothing was known.
+# The URLs the local model answered get 'local' in sources, when given.
+def check_categories(urls, tokens_per_url=TOKENS_PER_URL, sources=None):
+    urls = list(dict.fromkeys(urls))
+    categories = resolve_verdicts(
+        'category', urls,
+        lambda rest: classify_categories(rest, tokens_per_url, sources), sources)
+    return dict((url, categories.get(url, False)) for url in urls)
+
+# Function to classify URLs without a known verdict, returning all the
+# categories found and the ones that came from the LLM
+def classify_categories(urls, tokens_per_url=TOKENS_PER_URL, sources=None):
+    # Answers of the local model are not cached, so the cache only holds
+    # LLM verdicts the model can be retrained on
+    predictions = predict_categories(urls)
+    if sources is not None:
+        sources.update((url, 'local') for url in predictions)
+    missing = [url for url in urls if url not in predictions]
+    # OpenAI and its credentials are only needed for the URLs left
+    if not missing:
+        return predictions, {}
+
+    # Classify the URLs left for the LLM a batch at a time
+    llm = get_upstream('openai', transient_errors())
+    found = {}
+    try:
+        for i in range(0, len(missing), BATCH_SIZE):
+            found.update(llm.call(ask_categories, missing[i:i + BATCH_SIZE],
+                                  tokens_per_url))
+
+        # Ask about the URLs missing from the batched answers one by one
+        for url in missing:
+            if url not in found:
+                is_shopping = llm.call(ask_category, url)
+                if is_shopping is not None:
+                    found[url] = is_shopping
+    except UpstreamUnavailable:
+        # Fall back to old verdicts without caching them
+        unanswered = [url for url in missing if url not in found]
+        predictions.update(fallback_verdicts('category', unanswered, None))
+
+    return dict(predictions, **found), found
+
+# Function to ask for the categories of several URLs in one request
+def ask_categories(urls, tokens_per_url=TOKENS_PER_URL):
+    if len(urls) == 1:
+        is_shopping = ask_category(urls[0])
+        return {} if is_shopping is None else {urls[0]: is_shopping}
+
+    listing = "\n".join(f"{i}. {url}" for i, url in enumerate(urls, 1))
+    prompt = ("Please classify the category of each numbered URL below as 'shopping' or 'information'. "
+              "Answer with one line per URL in the form '<number>: <category>'.\n"
+              f"{listing}\n")
+    metrics.count('upstream_requests_total', upstream='openai')
+    completions = get_openai().Completion.create(
+        engine=model_engine,
+        prompt=prompt,
+        max_tokens=tokens_per_url * len(urls),
+        n=1,
+        stop=None,
+        temperature=0,
+        request_timeout=request_timeout(REQUEST_TIMEOUT),
+    )
+    if len(completions.choices) == 0:
+        return {}
+    return parse_categories(completions.choices[0].text, urls)
+
+# Function to read the "<number>: <category>" lines of a batched answer
+def parse_categories(text, urls):
+    answers = {}
+    conflicting = set()
+    for line in text.splitlines():
+        match = ANSWER_LINE.match(line)
+        if match is None:
+            continue
+        index = int(match.group(1)) - 1
+        if not 0 <= index < len(urls):
+            continue
+        is_shopping = match.group(2).lower() == 'shopping'
+        url = urls[index]
+        # Drop URLs that were answered twice with different categories
+        if answers.get(url, is_shopping) != is_shopping:
+            conflicting.add(url)
+        answers[url] = is_shopping
+    for url in conflicting:
+        del answers[url]
+    return answers
 
 if __name__=="__main__":
     url = "https://www.toysfortots.org"
@@ -0,0 +1,126 @@
+import shutil
+import tempfile
+import time
+import unittest
+
+import requests
+
+import safebrowsing_db
+from fake_upstreams import FakeUpstreams
+from safebrowsing_db import SafeBrowsingDatabase, DatabaseUnavailable
+
+
+class SafeBrowsingDatabaseTest(unittest.TestCase):
+    """Runs the Update API engine against the local Safe Browsing stand-in"""
+
+    def setUp(self):
+        self.upstreams = FakeUpstreams(0, 0, 0, 0)
+        self.upstreams.start()
+        self.directory = tempfile.mkdtemp()
+        self.database = self.open_database()
+
+    def tearDown(self):
+        self.upstreams.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def open_database(self):
+        return SafeBrowsingDatabase(
+            'fake', directory=self.directory,
+            api_base=self.upstreams.base_url + '/v4', session=requests.Session())
+
+    def malicious_site(self):
+        for k in range(1000):
+            if self.upstreams.is_malicious('site%d.example' % k):
+                return 'site%d.example' % k
+
+    def calls(self, method):
+        return self.upstreams.calls.get('/v4/' + method, 0)
+
+    def test_full_then_partial_update(self):
+        # Unsafe answers are not cached, so lookups follow the lists
+        self.upstreams.positive_cache_seconds = 0
+        self.database.update()
+        evil = self.malicious_site()
+        self.assertTrue(self.database.lookup_urls(['http://%s/' % evil])['http://%s/' % evil])
+        self.assertFalse(self.database.lookup_urls(['http://good.test/'])['http://good.test/'])
+
+        # One site comes off the list and another one goes on it
+        self.upstreams.set_malicious(evil, False)
+        self.upstreams.set_malicious('bad.test')
+        self.database.update()
+        verdicts = self.database.lookup_urls(['http://%s/' % evil, 'http://bad.test/'])
+        self.assertEqual(verdicts, {'http://%s/' % evil: False, 'http://bad.test/': True})
+        self.assertEqual(self.database.errors, 0)
+        malware = self.database.lists[safebrowsing_db.THREAT_LISTS[0]]
+        self.assertEqual(malware.prefixes(), self.upstreams.malware_prefixes())
+
+    def test_lists_survive_a_restart(self):
+        self.database.update()
+        self.upstreams.set_malicious('bad.test')
+        reopened = self.open_database()
+        reopened.update()
+        self.assertTrue(reopened.lookup_urls(['http://bad.test/'])['http://bad.test/'])
+
+    def test_checksum_mismatch_resets_the_list(self):
+        self.database.update()
+        self.upstreams.set_malicious('bad.test')
+        self.upstreams.corrupt_updates = 1
+        self.database.update()
+
+        # The reset lists are not trusted and are fetched again at once
+        self.assertLessEqual(self.database.next_update, time.time())
+        with self.assertRaises(DatabaseUnavailable):
+            self.database.update_if_due()
+        self.database.update()
+        self.assertEqual(self.database.errors, 0)
+        self.assertTrue(self.database.lookup_urls(['http://bad.test/'])['http://bad.test/'])
+
+    def test_repeated_checksum_mismatches_back_off(self):
+        self.upstreams.corrupt_updates = 2
+        self.database.update()
+        self.database.update()
+        self.assertGreater(self.database.next_update, time.time())
+        with self.assertRaises(DatabaseUnavailable):
+            self.database.update_if_due()
+
+    def test_expired_unsafe_hash_is_confirmed_again(self):
+        self.database.update()
+        evil = self.malicious_site()
+        url = 'http://%s/' % evil
+        self.upstreams.positive_cache_seconds = 0.2
+        self.assertTrue(self.database.lookup_urls([url])[url])
+        found = self.calls('fullHashes:find')
+
+        # The safe answer for the prefix is still fresh, the unsafe one not
+        time.sleep(0.3)
+        self.assertTrue(self.database.lookup_urls([url])[url])
+        self.assertEqual(self.calls('fullHashes:find'), found + 1)
+
+    def test_fresh_answers_are_not_asked_again(self):
+        self.database.update()
+        evil = self.malicious_site()
+        urls = ['http://%s/' % evil, 'http://good.test/']
+        self.database.lookup_urls(urls)
+        found = self.calls('fullHashes:find')
+        self.database.lookup_urls(urls)
+        self.assertEqual(self.calls('fullHashes:find'), found)
+
+    def test_hung_update_ends_and_backs_off(self):
+        timeout = safebrowsing_db.REQUEST_TIMEOUT
+        safebrowsing_db.REQUEST_TIMEOUT = 0.2
+        self.upstreams.update_delay = 1.0
+        try:
+            with self.assertRaises(DatabaseUnavailable):
+                self.database.update_if_due()
+            started = time.time()
+            while self.database.updating and time.time() - started < 2:
+                time.sleep(0.05)
+        finally:
+            safebrowsing_db.REQUEST_TIMEOUT = timeout
+        self.assertFalse(self.database.updating)
+        self.assertEqual(self.database.errors, 1)
+        self.assertGreater(self.database.next_update, time.time())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+import socket
+import threading
+import time
+from urllib.error import HTTPError
+from metrics import metrics
+
+# Connections kept open to each host; the hosts searched or classified
+# against the most get larger pools
+DEFAULT_POOL_SIZE = 10
+POOL_SIZES = {
+    'https://api.openai.com': 16,
+    'https://safebrowsing.googleapis.com': 8,
+    'https://www.google.com': 2,
+}
+# Times a connection that could not be made is tried again, as openai does
+CONNECTION_RETRIES = 2
+# Seconds the address of a host is remembered, 0 to look it up every time
+DNS_TTL = 300
+# Seconds a search page may take when no timeout is given
+SEARCH_TIMEOUT = 30
+
+
+class DnsCache(object):
+    """Remembers the addresses socket.getaddrinfo returns for a while"""
+
+    def __init__(self, ttl=DNS_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.getaddrinfo = None
+
+    def install(self):
+        # Every connection of the process resolves through the cache, which
+        # covers the libraries that do not take a session
+        if self.getaddrinfo is None:
+            self.getaddrinfo = socket.getaddrinfo
+            socket.getaddrinfo = self.lookup
+
+    def uninstall(self):
+        if self.getaddrinfo is not None:
+            socket.getaddrinfo = self.getaddrinfo
+            self.getaddrinfo = None
+
+    def lookup(self, *args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        addresses = self.getaddrinfo(*args, **kwargs)
+        with self.lock:
+            self.entries[key] = (now + self.ttl, addresses)
+        return addresses
+
+
+class Transport(object):
+    """One pooled HTTP session shared by every upstream client"""
+
+    def __init__(self, pool_sizes=None, default_pool_size=DEFAULT_POOL_SIZE,
+                 dns_ttl=DNS_TTL):
+        import requests
+
+        self.pool_sizes = dict(POOL_SIZES if pool_sizes is None else pool_sizes)
+        self.default_pool_size = default_pool_size
+        self.dns_ttl = dns_ttl
+        self.session = requests.Session()
+        self.adapters = {}
+        # Hosts without a pool size of their own share the default adapters
+        for prefix in ('https://', 'http://'):
+            self.mount(prefix, default_pool_size)
+        for prefix, size in self.pool_sizes.items():
+            self.mount(prefix, size)
+
+        self.dns = None
+        if dns_ttl:
+            self.dns = DnsCache(dns_ttl)
+            self.dns.install()
+
+    def mount(self, prefix, size):
+        from requests.adapters import HTTPAdapter
+        adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size,
+                              max_retries=CONNECTION_RETRIES)
+        self.session.mount(prefix, adapter)
+        self.adapters[prefix] = adapter
+
+    def get_page(self, url, user_agent=None, verify_ssl=True):
+        # googlesearch.get_page over the shared session; HTTP errors are
+        # raised as urllib errors, like the original does
+        import googlesearch
+        metrics.count('upstream_requests_total', upstream='search')
+        response = self.session.get(
+            url, headers={'User-Agent': user_agent or googlesearch.USER_AGENT},
+            verify=verify_ssl, timeout=SEARCH_TIMEOUT)
+        if response.status_code >= 400:
+            raise HTTPError(url, response.status_code, response.reason,
+                            response.headers, None)
+        return response.content
+
+    def patch_openai(self, openai):
+        # openai makes one session per thread; hand it the shared one instead
+        openai.api_requestor._make_session = lambda: self.session
+
+    async def async_session(self):
+        # An aiohttp session with the same pool sizes and DNS caching, for
+        # async callers such as openai.aiosession; it belongs to the running
+        # event loop and the caller closes it
+        import aiohttp
+        connector = aiohttp.TCPConnector(
+            limit_per_host=self.default_pool_size,
+            ttl_dns_cache=self.dns_ttl or None,
+            use_dns_cache=bool(self.dns_ttl))
+        return aiohttp.ClientSession(connector=connector)
+
+    def stats(self):
+        # Connections opened, requests sent and idle connections per host;
+        # the queue of a pool holds None for each connection not yet made
+        pools = []
+        for prefix, adapter in self.adapters.items():
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is None:
+                    continue
+                pools.append({
+                    'adapter': prefix,
+                    'host': '%s://%s:%s' % (pool.scheme, pool.host, pool.port),
+                    'maxsize': pool.pool.maxsize if pool.pool else 0,
+                    'idle': sum(1 for conn in list(pool.pool.queue)
+                                if conn is not None) if pool.pool else 0,
+                    'connections_opened': pool.num_connections,
+                    'requests': pool.num_requests,
+                })
+        stats = {'pools': pools}
+        if self.dns is not None:
+            stats['dns'] = {'hits': self.dns.hits, 'misses': self.dns.misses}
+        return stats
+
+    def prometheus(self, prefix='classifier'):
+        # Pool statistics in the Prometheus text format, as gauges
+        stats = self.stats()
+        lines = []
+        for field in ('maxsize', 'idle', 'connections_opened', 'requests'):
+            name = '%s_http_pool_%s' % (prefix, field)
+            lines.append('# TYPE %s gauge' % name)
+            for pool in stats['pools']:
+                lines.append('%s{host="%s"} %d' % (name, pool['host'], pool[field]))
+        if 'dns' in stats:
+            name = '%s_dns_cache_lookups' % prefix
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s{result="hit"} %d' % (name, stats['dns']['hits']))
+            lines.append('%s{result="miss"} %d' % (name, stats['dns']['misses']))
+        return '\n'.join(lines) + '\n'
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    # Create the shared transport on first use
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = Transport()
+    return _transport
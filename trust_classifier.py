@@ -1,28 +1,180 @@
-# Import the SafeBrowsing class from the pysafebrowsing library
-from pysafebrowsing import SafeBrowsing
-from shopping_classifier import get_credentials
+import json
+import threading
+from config import get_credentials
+from transport import get_transport
+from verdict_sharing import resolve_verdicts, fallback_verdicts
+from resilience import get_upstream, request_timeout, UpstreamUnavailable
+from metrics import metrics
+from safebrowsing_db import SafeBrowsingDatabase, DatabaseUnavailable
+
+API_URL = 'https://safebrowsing.googleapis.com/v4/threatMatches:find'
+# The Lookup API accepts at most 500 threat entries per threatMatches request
+MAX_URLS_PER_REQUEST = 500
+# Seconds a lookup request may take outside of an upstream deadline
+REQUEST_TIMEOUT = 30
+# Check URLs against a local copy of the threat lists, so that only URLs
+# matching a hash prefix are sent to Google
+USE_LOCAL_DATABASE = True
+THREAT_TYPES = [
+    "MALWARE",
+    "SOCIAL_ENGINEERING",
+    "THREAT_TYPE_UNSPECIFIED",
+    "UNWANTED_SOFTWARE",
+    "POTENTIALLY_HARMFUL_APPLICATION",
+]
+
+
+class SafeBrowsingClient(object):
+    """Safe Browsing Lookup API client that keeps one HTTP session open"""
+
+    def __init__(self, key, api_url=API_URL, session=None):
+        self.api_key = key
+        self.api_url = api_url
+        # Connections are pooled with the other upstream clients by default
+        self.session = session or get_transport().session
+
+    def lookup_urls(self, urls, platforms=["ANY_PLATFORM"]):
+        # Pack as many URLs as the API allows into each request
+        results = {}
+        for i in range(0, len(urls), MAX_URLS_PER_REQUEST):
+            results.update(self._lookup_batch(
+                urls[i:i + MAX_URLS_PER_REQUEST], platforms))
+        return results
+
+    def _lookup_batch(self, urls, platforms):
+        data = {
+            "client": {
+                "clientId": "pysafebrowsing",
+                "clientVersion": "0.1"
+            },
+            "threatInfo": {
+                "threatTypes": THREAT_TYPES,
+                "platformTypes": platforms,
+                "threatEntryTypes": ["URL"],
+                "threatEntries": [{'url': u} for u in urls]
+            }
+        }
+        metrics.count('upstream_requests_total', upstream='safebrowsing')
+        r = self.session.post(
+            self.api_url,
+            data=json.dumps(data),
+            params={'key': self.api_key},
+            headers={'Content-type': 'application/json'},
+            timeout=request_timeout(REQUEST_TIMEOUT)
+        )
+        if r.status_code != 200:
+            raise _lookup_error(r)
+
+        # URLs without a match in the response are clean
+        results = dict((u, {"malicious": False}) for u in urls)
+        for match in r.json().get('matches', []):
+            url = match['threat']['url']
+            if url not in results:
+                continue
+            result = results[url]
+            if not result['malicious']:
+                result.update({'malicious': True, 'platforms': [],
+                               'threats': [], 'cache': match['cacheDuration']})
+            if match['platformType'] not in result['platforms']:
+                result['platforms'].append(match['platformType'])
+            if match['threatType'] not in result['threats']:
+                result['threats'].append(match['threatType'])
+            result['cache'] = min(result['cache'], match['cacheDuration'])
+        return results
+
+
+def _lookup_error(r):
+    # Map an error response to the matching pysafebrowsing exception
+    from pysafebrowsing.api import (SafeBrowsingInvalidApiKey,
+                                    SafeBrowsingPermissionDenied,
+                                    SafeBrowsingWeirdError)
+    try:
+        error = r.json()['error']
+    except (ValueError, KeyError):
+        return SafeBrowsingWeirdError(r.status_code, "", r.text)
+    if r.status_code == 400 and \
+            error['message'] == 'API key not valid. Please pass a valid API key.':
+        return SafeBrowsingInvalidApiKey()
+    if r.status_code == 403:
+        return SafeBrowsingPermissionDenied(error['message'])
+    return SafeBrowsingWeirdError(error.get('code', r.status_code),
+                                  error.get('status', ""), error['message'])
+
+
+def transient_errors():
+    # Errors of Safe Browsing lookups that are worth trying again
+    import requests
+    from pysafebrowsing.api import SafeBrowsingWeirdError
+    return (requests.RequestException, SafeBrowsingWeirdError)
+
+
+_client = None
+_database = None
+_lock = threading.Lock()
+
+
+def get_client():
+    # Create the Safe Browsing client once and share it between lookups
+    global _client
+    with _lock:
+        if _client is None:
+            _client = SafeBrowsingClient(get_credentials("google_safe"))
+    return _client
+
+
+def get_database():
+    # Open the local threat lists once and share them between lookups
+    global _database
+    with _lock:
+        if _database is None:
+            _database = SafeBrowsingDatabase(get_credentials("google_safe"),
+                                             session=get_transport().session)
+    return _database
+
+
+def lookup_malicious(urls):
+    # Return a dict of URL to whether it is malicious, from the local threat
+    # lists when they are usable and from the Lookup API otherwise
+    if USE_LOCAL_DATABASE:
+        import requests
+        try:
+            return get_database().lookup_urls(urls)
+        except (DatabaseUnavailable, requests.RequestException):
+            pass
+    r = get_client().lookup_urls(urls)
+    return dict((url, r[url].get('malicious', False)) for url in urls)
+
+
+# Define a function to check a whole page of URLs with as few requests as possible
+def check_urls(urls):
+    # Drop duplicates but keep the order of the URLs
+    urls = list(dict.fromkeys(urls))
+    if not urls:
+        return {}
+
+    statuses = resolve_verdicts('trust', urls, classify_statuses)
+    return dict((url, statuses[url]) for url in urls)
+
+
+def classify_statuses(urls):
+    try:
+        malicious = get_upstream('safebrowsing', transient_errors()).call(
+            lookup_malicious, urls)
+    except UpstreamUnavailable:
+        # Fall back to old verdicts, or 'Unknown', without caching them
+        return fallback_verdicts('trust', urls, 'Unknown'), {}
+
+    # Return 'Non-trusted' for malicious URLs and 'Trusted' for safe ones
+    found = dict((url, 'Non-trusted' if malicious[url] else 'Trusted')
+                 for url in urls)
+    return found, found
+
 
 # Define a function to check if a URL is safe
 def check_url(url):
-    
-    # Set the API key for Google Safe Browsing API
-    KEY = get_credentials("google_safe") # Replace with your Google Safe Browsing API key
-    
-    # Create a SafeBrowsing object with the API key
-    s = SafeBrowsing(KEY)
-    
-    # Use the lookup_urls method to check if the given URL is malicious
-    r = s.lookup_urls([url])
-    
-    # Check the 'malicious' key in the response for the URL
-    if r[url].get('malicious', False):
-        # Return 'Non-trusted' if the URL is malicious
-        return 'Non-trusted'
-    else:
-        # Return 'Trusted' if the URL is safe
-        return 'Trusted'
+    return check_urls([url])[url]
 
 # Example usage:
 #url = 'http://google.com'
-#url = 'http://malware.testing.google.test/testing/malware/' 
+#url = 'http://malware.testing.google.test/testing/malware/'
 #print(check_url(url)) # Output: Non-trusted
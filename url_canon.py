@@ -0,0 +1,91 @@
+import os
+import re
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# A copy of https://publicsuffix.org/list/public_suffix_list.dat, when present,
+# replaces the built-in suffixes below
+SUFFIX_FILENAME = 'public_suffix_list.dat'
+
+# Public suffixes of more than one label that shopping searches run into,
+# including hosting suffixes whose subdomains belong to different owners
+SUFFIXES = set("""
+    co.uk org.uk ac.uk gov.uk me.uk ltd.uk plc.uk net.uk sch.uk nhs.uk
+    com.au net.au org.au edu.au gov.au asn.au id.au co.nz org.nz net.nz
+    co.jp ne.jp or.jp ac.jp go.jp co.kr or.kr ne.kr co.in net.in org.in
+    firm.in gen.in ind.in com.br net.br org.br com.cn net.cn org.cn gov.cn
+    com.mx org.mx com.ar com.tr com.sg com.my com.hk com.tw com.pk com.ng
+    com.eg com.sa com.vn com.ph com.co com.pe com.ua co.za co.id co.il
+    co.th ac.th com.pl net.pl org.pl
+    github.io gitlab.io blogspot.com appspot.com herokuapp.com netlify.app
+    vercel.app web.app firebaseapp.com pages.dev workers.dev
+    azurewebsites.net cloudfront.net myshopify.com wixsite.com
+    wordpress.com tumblr.com
+""".split())
+
+# Query parameters that only track where a visitor came from
+TRACKING_PARAMS = {'gclid', 'dclid', 'fbclid', 'msclkid', 'yclid', 'igshid',
+                   'mc_cid', 'mc_eid', '_ga', '_gl', 'ref_src'}
+TRACKING_PREFIXES = ('utm_',)
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+IP_ADDRESS = re.compile(r'^[\d.]+$|^\[?[0-9a-f:]+\]?$')
+
+_suffixes = None
+
+
+def public_suffixes():
+    # Load the public suffix list once, falling back to the built-in suffixes
+    global _suffixes
+    if _suffixes is None:
+        suffixes = set(SUFFIXES)
+        if os.path.isfile(SUFFIX_FILENAME):
+            with open(SUFFIX_FILENAME, 'r', encoding='utf-8') as f:
+                for line in f:
+                    rule = line.strip()
+                    # Wildcard and exception rules are rare enough to skip
+                    if rule and not rule.startswith(('//', '*', '!')):
+                        suffixes.add(rule.lower())
+        _suffixes = suffixes
+    return _suffixes
+
+
+def normalize_url(url):
+    # Canonical form of a URL, so that equivalent URLs share one verdict:
+    # - lowercase scheme and host, https for http as verdicts do not depend on it
+    # - no default port, fragment, tracking parameters or trailing slash
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').rstrip('.')
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    # hostname drops the brackets around IPv6 addresses; put them back
+    netloc = '[%s]' % host if ':' in host else host
+    if port and port != DEFAULT_PORTS.get(scheme):
+        netloc = '%s:%d' % (netloc, port)
+    if scheme == 'http':
+        scheme = 'https'
+    path = parts.path.rstrip('/')
+    query = urlencode([(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                       if k.lower() not in TRACKING_PARAMS and
+                       not k.lower().startswith(TRACKING_PREFIXES)])
+    return urlunsplit((scheme, netloc, path, query, ''))
+
+
+def registrable_domain(host):
+    # The public suffix of the host plus one label (eTLD+1), e.g. bbc.co.uk
+    host = host.lower().rstrip('.')
+    if not host or IP_ADDRESS.match(host):
+        return host
+    labels = host.split('.')
+    suffixes = public_suffixes()
+    for i in range(len(labels)):
+        if '.'.join(labels[i:]) in suffixes:
+            return '.'.join(labels[max(0, i - 1):])
+    # Otherwise the top-level domain is the public suffix
+    return '.'.join(labels[-2:])
+
+
+def domain_of(url):
+    return registrable_domain(urlsplit(url.strip()).hostname or '')
@@ -0,0 +1,188 @@
+import argparse
+import json
+import math
+import os
+import random
+import re
+import threading
+import zlib
+from urllib.parse import urlsplit, parse_qsl
+from url_canon import normalize_url
+
+MODEL_FILENAME = 'url_model.json'
+# Number of hashed feature buckets
+BUCKETS = 2 ** 18
+# URLs scored with less confidence than this are sent to the LLM
+CONFIDENCE = 0.9
+EPOCHS = 20
+LEARNING_RATE = 0.2
+L2 = 1e-4
+
+TOKEN = re.compile(r'[a-z0-9]+')
+
+
+def features(url):
+    # Hash the host, domain, host labels and path and query tokens of a URL
+    parts = urlsplit(url.lower())
+    host = (parts.hostname or '')
+    if host.startswith('www.'):
+        host = host[4:]
+    labels = host.split('.')
+    words = ['h:' + host, 'd:' + '.'.join(labels[-2:]),
+             't:' + labels[-1]]
+    words.extend('l:' + label for label in labels[:-1])
+    path_tokens = TOKEN.findall(parts.path)
+    words.extend('p:' + token for token in path_tokens)
+    words.extend('p2:%s_%s' % pair for pair in zip(path_tokens, path_tokens[1:]))
+    words.extend('q:' + key for key, _ in parse_qsl(parts.query))
+    words.append('depth:%d' % min(len(path_tokens), 6))
+    # Numbers in the path usually belong to dated articles or product ids
+    words.append('digits:%d' % min(sum(t.isdigit() for t in path_tokens), 3))
+    return [zlib.crc32(word.encode('utf-8')) % BUCKETS for word in words]
+
+
+class UrlModel(object):
+    """Logistic regression over hashed URL features scoring how likely a URL is a shop"""
+
+    def __init__(self, weights=None, bias=0.0):
+        self.weights = weights or {}
+        self.bias = bias
+
+    def score(self, url):
+        z = self.bias + sum(self.weights.get(i, 0.0) for i in features(url))
+        z = max(-30.0, min(30.0, z))
+        return 1.0 / (1.0 + math.exp(-z))
+
+    def predict(self, url, confidence=CONFIDENCE):
+        # Return True or False when the model is confident enough, else None
+        p = self.score(url)
+        if p >= confidence:
+            return True
+        if p <= 1.0 - confidence:
+            return False
+        return None
+
+    def fit(self, examples, epochs=EPOCHS, learning_rate=LEARNING_RATE, l2=L2):
+        # Stochastic gradient descent on (url, is_shopping) examples
+        examples = [(features(url), 1.0 if label else 0.0)
+                    for url, label in examples]
+        rng = random.Random(0)
+        for epoch in range(epochs):
+            rng.shuffle(examples)
+            rate = learning_rate / (1.0 + epoch)
+            for indexes, label in examples:
+                z = self.bias + sum(self.weights.get(i, 0.0) for i in indexes)
+                z = max(-30.0, min(30.0, z))
+                gradient = 1.0 / (1.0 + math.exp(-z)) - label
+                self.bias -= rate * gradient
+                for i in indexes:
+                    w = self.weights.get(i, 0.0)
+                    self.weights[i] = w - rate * (gradient + l2 * w)
+        return self
+
+    def save(self, filename=MODEL_FILENAME):
+        data = {'buckets': BUCKETS, 'bias': self.bias,
+                'weights': dict((str(i), w) for i, w in self.weights.items())}
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename=MODEL_FILENAME):
+        with open(filename, 'r') as f:
+            data = json.load(f)
+        if data['buckets'] != BUCKETS:
+            raise ValueError('%s was trained with %d feature buckets, not %d'
+                             % (filename, data['buckets'], BUCKETS))
+        return cls(dict((int(i), w) for i, w in data['weights'].items()),
+                   data['bias'])
+
+
+def training_examples(store=None, cache=None):
+    # Labelled URLs from the saved searches and the verdict cache, the newest
+    # verdict of a URL winning; the model's own answers are left out. URLs
+    # are normalized like the cache's, so that no URL is in both halves of
+    # a split.
+    examples = {}
+    if store is not None:
+        for search in store.searches():
+            for result in search['results']:
+                if result.get('Source') == 'local':
+                    continue
+                if result['Category'] in ('Shopping', 'Information'):
+                    examples[normalize_url(result['URL'])] = (
+                        result['Category'] == 'Shopping')
+    if cache is not None:
+        examples.update(cache.items('category'))
+    return list(examples.items())
+
+
+def evaluate(model, examples, confidence=CONFIDENCE):
+    # Accuracy of the confident answers and the share of URLs they cover,
+    # which is the share of LLM calls the model saves
+    answered = correct = 0
+    for url, label in examples:
+        prediction = model.predict(url, confidence)
+        if prediction is not None:
+            answered += 1
+            correct += prediction == label
+    total = len(examples)
+    return {
+        'examples': total,
+        'answered': answered,
+        'coverage': answered / total if total else 0.0,
+        'accuracy': correct / answered if answered else 0.0,
+    }
+
+
+def split(examples, holdout=0.2, seed=0):
+    examples = sorted(examples)
+    random.Random(seed).shuffle(examples)
+    cut = int(len(examples) * (1 - holdout))
+    return examples[:cut], examples[cut:]
+
+
+_model = None
+_model_loaded = False
+_model_lock = threading.Lock()
+
+
+def get_model():
+    # Load the trained model on first use, None until one has been trained
+    global _model, _model_loaded
+    with _model_lock:
+        if not _model_loaded:
+            _model_loaded = True
+            if os.path.isfile(MODEL_FILENAME):
+                _model = UrlModel.load()
+    return _model
+
+
+def main():
+    from results_store import get_store
+    from verdict_cache import get_cache
+
+    parser = argparse.ArgumentParser(
+        description='Train or evaluate the local URL category model')
+    parser.add_argument('command', choices=['train', 'evaluate'])
+    parser.add_argument('--model', default=MODEL_FILENAME)
+    parser.add_argument('--confidence', type=float, default=CONFIDENCE)
+    parser.add_argument('--holdout', type=float, default=0.2,
+                        help='share of the examples held out by evaluate')
+    args = parser.parse_args()
+
+    examples = training_examples(get_store(), get_cache())
+    if args.command == 'train':
+        model = UrlModel().fit(examples)
+        model.save(args.model)
+        print('Trained on %d URLs, saved to %s' % (len(examples), args.model))
+        report = evaluate(model, examples, args.confidence)
+    else:
+        train, test = split(examples, args.holdout)
+        report = evaluate(UrlModel().fit(train), test, args.confidence)
+    print(json.dumps(report, indent=4))
+
+
+if __name__ == '__main__':
+    main()
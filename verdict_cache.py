@@ -0,0 +1,182 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from results_store import get_store
+from metrics import metrics
+from url_canon import normalize_url
+
+CACHE_FILENAME = 'verdict_cache.db'
+
+# Time to live of each kind of verdict, in seconds. Whether a site is a shop
+# rarely changes, while the Safe Browsing threat lists are updated often.
+TTLS = {
+    'category': 30 * 24 * 60 * 60,
+    'trust': 6 * 60 * 60,
+}
+# Categories shared by a whole registrable domain live as long as per-URL ones
+TTLS['category_domain'] = TTLS['category']
+# Least recently used entries are evicted above this many verdicts
+MAX_ENTRIES = 100000
+
+
+class VerdictCache(object):
+    """On-disk cache of category and trust verdicts keyed by normalized URL"""
+
+    def __init__(self, path=CACHE_FILENAME, ttls=None, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.ttls = dict(TTLS, **(ttls or {}))
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS verdicts (
+                kind TEXT NOT NULL,
+                url TEXT NOT NULL,
+                verdict TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL,
+                PRIMARY KEY (kind, url)
+            );
+            CREATE INDEX IF NOT EXISTS verdicts_accessed ON verdicts (accessed);
+            CREATE TABLE IF NOT EXISTS warmed_until (
+                source TEXT PRIMARY KEY,
+                timestamp REAL NOT NULL
+            );
+        """)
+
+    def get(self, kind, url):
+        return self.get_many(kind, [url]).get(url)
+
+    def key(self, kind, url):
+        # Domain verdicts are keyed by the domain itself
+        if kind.endswith('_domain'):
+            return url.lower()
+        return normalize_url(url)
+
+    def get_many(self, kind, urls, stale=False):
+        # Return the verdicts that are still fresh, keyed by the given URLs;
+        # stale also returns expired ones, for when nothing better is at hand
+        keys = dict((url, self.key(kind, url)) for url in urls)
+        if not keys:
+            return {}
+        now = time.time()
+        oldest = 0 if stale else now - self.ttls[kind]
+        found = {}
+        with self.lock:
+            for key in set(keys.values()):
+                row = self.db.execute(
+                    'SELECT verdict FROM verdicts '
+                    'WHERE kind = ? AND url = ? AND created >= ?',
+                    (kind, key, oldest)).fetchone()
+                if row is not None:
+                    found[key] = json.loads(row[0])
+            if found:
+                self.db.executemany(
+                    'UPDATE verdicts SET accessed = ? WHERE kind = ? AND url = ?',
+                    [(now, kind, key) for key in found])
+                self.db.commit()
+        hits = dict((url, found[key]) for url, key in keys.items() if key in found)
+        if stale:
+            metrics.count('cache_stale_hits_total', len(hits), kind=kind)
+        else:
+            metrics.count('cache_hits_total', len(hits), kind=kind)
+            metrics.count('cache_misses_total', len(keys) - len(hits), kind=kind)
+        return hits
+
+    def set(self, kind, url, verdict):
+        self.set_many(kind, {url: verdict})
+
+    def set_many(self, kind, verdicts, created=None, replace=True):
+        now = time.time()
+        created = now if created is None else created
+        rows = [(kind, self.key(kind, url), json.dumps(verdict), created, now)
+                for url, verdict in verdicts.items()]
+        verb = 'INSERT OR REPLACE' if replace else 'INSERT OR IGNORE'
+        with self.lock:
+            self.db.executemany(
+                verb + ' INTO verdicts VALUES (?, ?, ?, ?, ?)', rows)
+            self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        # Drop the least recently used verdicts above the size cap
+        count = self.db.execute('SELECT COUNT(*) FROM verdicts').fetchone()[0]
+        if count > self.max_entries:
+            self.db.execute(
+                'DELETE FROM verdicts WHERE rowid IN (SELECT rowid FROM verdicts '
+                'ORDER BY accessed LIMIT ?)', (count - self.max_entries,))
+
+    def items(self, kind):
+        # Every stored verdict of a kind, fresh or not, keyed by normalized URL
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT url, verdict FROM verdicts WHERE kind = ?', (kind,))
+            return dict((url, json.loads(verdict)) for url, verdict in rows)
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM verdicts')
+            self.db.commit()
+
+    def warm_from_history(self, store):
+        # Load the verdicts of the searches saved since the last warm-up
+        if not os.path.exists(store.path):
+            return
+        source = os.path.abspath(store.path)
+        with self.lock:
+            row = self.db.execute('SELECT timestamp FROM warmed_until '
+                                  'WHERE source = ?', (source,)).fetchone()
+        # Searches are appended in time order, so only the ones since the
+        # newest one already loaded are read; that one is read again, and
+        # loading it again changes nothing
+        if row is None:
+            searches = store.searches()
+        else:
+            searches = store.between(row[0], float('inf'))
+        if not searches:
+            return
+
+        # Verdicts age from the time of their search, newest first, and never
+        # overwrite fresher ones already in the cache
+        for search in reversed(searches):
+            categories, statuses = search_verdicts(search)
+            self.set_many('category', categories, search['timestamp'], False)
+            self.set_many('trust', statuses, search['timestamp'], False)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO warmed_until VALUES (?, ?)',
+                            (source, searches[-1]['timestamp']))
+            self.db.commit()
+
+
+def search_verdicts(search):
+    # Extract the category and trust verdicts from a saved search, leaving
+    # out the ones that were unknown at the time and the categories of the
+    # local model, which the cache never holds
+    categories = {}
+    statuses = {}
+    for result in search['results']:
+        url = result['URL']
+        if (result.get('Source') != 'local' and
+                result['Category'] in ('Shopping', 'Information')):
+            categories[url] = result['Category'] == 'Shopping'
+        if result['Trusted'] == 'Yes':
+            statuses[url] = 'Trusted'
+        elif result['Trusted'] == 'No':
+            statuses[url] = 'Non-trusted'
+    return categories, statuses
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    # Open the shared cache on first use and warm it from the search history
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = VerdictCache()
+            _cache.warm_from_history(get_store())
+    return _cache
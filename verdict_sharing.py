@@ -0,0 +1,109 @@
+import json
+import os
+import threading
+from url_canon import normalize_url, domain_of
+from verdict_cache import get_cache
+
+# Kinds of verdict classified once per registrable domain and shared with
+# every URL under it. Only categories are: one unsafe page does not make the
+# rest of its domain unsafe, nor does one safe page make the rest safe.
+SHARE_DOMAINS = {'category'}
+# Per-URL verdicts that win over everything else, as
+# {"category": {url: true/false}, "trust": {url: "Trusted"/"Non-trusted"}}
+OVERRIDES_FILENAME = 'verdict_overrides.json'
+
+
+class Overrides(object):
+    """Verdicts fixed by hand for single URLs, saved in a JSON file"""
+
+    def __init__(self, filename=OVERRIDES_FILENAME):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.verdicts = {'category': {}, 'trust': {}}
+        if os.path.isfile(filename):
+            with open(filename, 'r') as f:
+                for kind, verdicts in json.load(f).items():
+                    self.verdicts[kind] = dict(
+                        (normalize_url(url), v) for url, v in verdicts.items())
+
+    def get_many(self, kind, urls):
+        with self.lock:
+            verdicts = self.verdicts.get(kind, {})
+            if not verdicts:
+                return {}
+            return dict((url, verdicts[normalize_url(url)]) for url in urls
+                        if normalize_url(url) in verdicts)
+
+    def set(self, kind, url, verdict):
+        with self.lock:
+            self.verdicts.setdefault(kind, {})[normalize_url(url)] = verdict
+            tmp_filename = self.filename + '.tmp'
+            with open(tmp_filename, 'w') as f:
+                json.dump(self.verdicts, f, indent=4)
+            os.replace(tmp_filename, self.filename)
+
+
+_overrides = None
+_overrides_lock = threading.Lock()
+
+
+def get_overrides():
+    global _overrides
+    with _overrides_lock:
+        if _overrides is None:
+            _overrides = Overrides()
+    return _overrides
+
+
+def fallback_verdicts(kind, urls, unknown):
+    # Verdicts for URLs an unavailable upstream could not classify: the last
+    # verdict known for the URL or its domain, however old, otherwise unknown
+    cache = get_cache()
+    verdicts = cache.get_many(kind, urls, stale=True)
+    rest = [url for url in urls if url not in verdicts]
+    if kind in SHARE_DOMAINS and rest:
+        domains = cache.get_many(kind + '_domain',
+                                 set(domain_of(url) for url in rest), stale=True)
+        for url in rest:
+            if domain_of(url) in domains:
+                verdicts[url] = domains[domain_of(url)]
+    return dict((url, verdicts.get(url, unknown)) for url in urls)
+
+
+def resolve_verdicts(kind, urls, classify, sources=None):
+    # Verdicts of the URLs from the overrides, the cache and, for the rest,
+    # classify(urls), which returns the verdicts it found and the subset of
+    # them worth caching. For kinds in SHARE_DOMAINS only one URL per domain
+    # is classified and its verdict, with its entry in sources, is fanned
+    # out to the others.
+    verdicts = get_overrides().get_many(kind, urls)
+    cache = get_cache()
+    rest = [url for url in urls if url not in verdicts]
+    verdicts.update(cache.get_many(kind, rest))
+    rest = [url for url in rest if url not in verdicts]
+
+    if kind in SHARE_DOMAINS:
+        domains = {}
+        for url in rest:
+            domains.setdefault(domain_of(url), []).append(url)
+        for domain, verdict in cache.get_many(kind + '_domain', domains).items():
+            for url in domains.pop(domain):
+                verdicts[url] = verdict
+        groups = dict((members[0], members) for members in domains.values())
+    else:
+        groups = dict((url, [url]) for url in rest)
+    if not groups:
+        return verdicts
+
+    found, fresh = classify(list(groups))
+    for url, members in groups.items():
+        if url in found:
+            for member in members:
+                verdicts[member] = found[url]
+                if sources is not None and url in sources:
+                    sources[member] = sources[url]
+    cache.set_many(kind, fresh)
+    if kind in SHARE_DOMAINS:
+        cache.set_many(kind + '_domain', dict(
+            (domain_of(url), verdict) for url, verdict in fresh.items()))
+    return verdicts